@@ -1,5 +1,7 @@
+from pydantic import SecretStr
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import Optional
 import os
 
 
@@ -8,13 +10,19 @@ class Settings(BaseSettings):
     
     # Database
     database_url: str = os.getenv("DATABASE_URL", "sqlite:///./mediameter.db")
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "20"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    db_pool_timeout: int = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # секунды
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # секунды
+    db_query_cache_size: int = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))  # скомпилированных SQL
     
     # API
     api_key: str = os.getenv("API_KEY", "dev_key_change_in_prod")
     secret_key: str = os.getenv("SECRET_KEY", "dev_secret_change_in_prod")
+    api_key_cache_ttl: int = int(os.getenv("API_KEY_CACHE_TTL", "60"))  # секунды
     
-    # OpenAI
-    OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
+    # OpenAI (читается из OPENAI_API_KEY, раскрывается только в get_openai_key)
+    openai_api_key: Optional[SecretStr] = None
     
     # Redis (опционально)
     redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
@@ -30,9 +38,12 @@ class Settings(BaseSettings):
         env_file = ".env"
 
 
-@lru_cache()
-def get_settings() -> Settings:
-    return Settings()
+settings = Settings()
 
 
-settings = get_settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_openai_key() -> str:
+    """Ключ OpenAI - запрашивается только при первом обращении к GPT"""
+    if not settings.openai_api_key:
+        raise RuntimeError("OPENAI_API_KEY is not configured")
+    return settings.openai_api_key.get_secret_value()
@@ -1,19 +1,62 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import Enum, Integer, create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker, Session
-from .models import Base, APIKey, Person
+from sqlalchemy.pool import StaticPool
+from .config import settings
+from .models import (
+    Base, APIKey, Person, Mention, DailyAggregate, HourlyAggregate, AnalysisCache, EnumInt,
+    person_mention, mention_entity, mention_topic,
+)
 
 # Получить DATABASE_URL напрямую из окружения
 database_url = os.getenv("DATABASE_URL", "sqlite:///./mediameter.db")
 
+# PostgreSQL без явного драйвера - через psycopg 3, если он установлен:
+# быстрее разбирает числовые и временные колонки метрик, чем psycopg2
+if database_url.startswith(("postgresql://", "postgres://")):
+    try:
+        import psycopg  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        database_url = "postgresql+psycopg://" + database_url.split("://", 1)[1]
+
+# Параметры пула зависят от СУБД
+if "sqlite" in database_url:
+    engine_kwargs = {"connect_args": {"check_same_thread": False}}
+    if database_url in ("sqlite://", "sqlite:///:memory:"):
+        # In-memory БД живёт в одном соединении - делить его между потоками
+        engine_kwargs["poolclass"] = StaticPool
+else:
+    engine_kwargs = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+    }
+
 # Создание engine
 engine = create_engine(
     database_url,
-    connect_args={"check_same_thread": False} if "sqlite" in database_url else {},
     echo=os.getenv("DEBUG", "False").lower() == "true",
     pool_pre_ping=True,
+    # Кэш скомпилированных запросов: метрики строят много вариантов select (персона/период/диалект)
+    query_cache_size=settings.db_query_cache_size,
+    **engine_kwargs,
 )
 
+if "sqlite" in database_url:
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL: читатели не блокируют писателя; mmap и кэш страниц для тяжёлых SELECT"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+        cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def get_db() -> Session:
@@ -27,39 +70,134 @@ def get_db() -> Session:
 def init_db():
     """Инициализация всех таблиц"""
     Base.metadata.create_all(bind=engine)
+    _migrate_columns()
+    _create_missing_indexes()
     print("✓ База данных инициализирована")
     
-    # Create default dev API key
+    seed_db()
+    
+    # Заполнить агрегаты для БД, созданных до их появления
     db = SessionLocal()
     try:
-        dev_key = db.query(APIKey).filter(APIKey.key == "dev_key_change_in_prod").first()
-        if not dev_key:
-            dev_key = APIKey(
+        empty = not db.query(DailyAggregate.id).first() or not db.query(HourlyAggregate.id).first()
+        if empty and db.query(Mention.id).first():
+            from .services.aggregates import AggregateService
+            buckets = AggregateService.rebuild(db)
+            db.commit()
+            print(f"✓ Aggregates rebuilt: {buckets}")
+    except Exception as e:
+        db.rollback()
+        print(f"⚠ Error: {e}")
+    finally:
+        db.close()
+
+def seed_db():
+    """Создать dev API ключ и тестовую персону, если их ещё нет"""
+    with engine.begin() as conn:
+        result = conn.execute(
+            dialect_insert(conn, APIKey).values(
                 key="dev_key_change_in_prod",
                 name="Development Key",
                 active=True,
-            )
-            db.add(dev_key)
+            ).on_conflict_do_nothing()
+        )
+        if result.rowcount:
             print("✓ Dev API key created")
         
-        # Create test person if none exists
-        test_person = db.query(Person).filter(Person.slug == "test-person").first()
-        if not test_person:
-            test_person = Person(
+        result = conn.execute(
+            dialect_insert(conn, Person).values(
                 name="Test Person",
                 slug="test-person",
                 name_variants=["Test", "Test Person"],
                 active=True,
-            )
-            db.add(test_person)
+            ).on_conflict_do_nothing()
+        )
+        if result.rowcount:
             print("✓ Test person created")
+
+def dialect_insert(bind, model):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД (SQLite или PostgreSQL)"""
+    if bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+def _migrate_columns():
+    """Привести колонки существующей БД к текущим моделям"""
+    postgres = engine.dialect.name == "postgresql"
+    columns = {column["name"]: column for column in inspect(engine).get_columns("mentions")}
+    aggregate_columns = {column["name"] for column in inspect(engine).get_columns("daily_aggregates")}
+    
+    with engine.begin() as conn:
+        if "content_hash" not in columns:
+            conn.execute(text("ALTER TABLE mentions ADD COLUMN content_hash VARCHAR(40)"))
+            print("✓ Колонка mentions.content_hash добавлена")
         
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        print(f"⚠ Error: {e}")
-    finally:
-        db.close()
+        if "sentiment_weighted" not in aggregate_columns:
+            conn.execute(text("ALTER TABLE daily_aggregates ADD COLUMN sentiment_weighted FLOAT DEFAULT 0"))
+            # Старые строки без новой суммы - очистить, init_db пересчитает агрегаты
+            conn.execute(text("DELETE FROM daily_aggregates"))
+            print("✓ Колонка daily_aggregates.sentiment_weighted добавлена")
+        
+        # sentiment_label: Enum хранил имена (POSITIVE), теперь строка со значением (positive)
+        if postgres:
+            # PG ENUM отражается как sqltypes.Enum - подкласс String, проверять именно Enum
+            if isinstance(columns["sentiment_label"]["type"], Enum):
+                conn.execute(text(
+                    "ALTER TABLE mentions ALTER COLUMN sentiment_label TYPE VARCHAR(10) "
+                    "USING lower(sentiment_label::text)"
+                ))
+                print("✓ Колонка mentions.sentiment_label переведена в VARCHAR")
+        else:
+            conn.execute(text(
+                "UPDATE mentions SET sentiment_label = lower(sentiment_label) "
+                "WHERE sentiment_label IN ('POSITIVE', 'NEGATIVE', 'NEUTRAL')"
+            ))
+        
+        # EnumInt-колонки: Enum хранил имена членов, теперь SMALLINT-коды
+        for table in (Mention.__table__, DailyAggregate.__table__):
+            existing = {column["name"]: column for column in inspect(conn).get_columns(table.name)}
+            for column in table.columns:
+                if not isinstance(column.type, EnumInt):
+                    continue
+                cases = " ".join(
+                    f"WHEN '{member.name}' THEN {code}" for member, code in column.type.codes.items()
+                )
+                if postgres:
+                    if not isinstance(existing[column.name]["type"], Integer):
+                        conn.execute(text(
+                            f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE SMALLINT "
+                            f"USING CASE {column.name}::text {cases} END"
+                        ))
+                        print(f"✓ Колонка {table.name}.{column.name} переведена в SMALLINT")
+                else:
+                    names = ", ".join(f"'{member.name}'" for member in column.type.codes)
+                    conn.execute(text(
+                        f"UPDATE {table.name} SET {column.name} = CASE {column.name} {cases} END "
+                        f"WHERE {column.name} IN ({names})"
+                    ))
+        
+        # analysis_cache: метки времени в UTC с часовым поясом
+        if postgres:
+            for column in inspect(conn).get_columns("analysis_cache"):
+                if column["name"] in ("created_at", "expires_at") and not column["type"].timezone:
+                    conn.execute(text(
+                        f"ALTER TABLE analysis_cache ALTER COLUMN {column['name']} TYPE TIMESTAMPTZ "
+                        f"USING {column['name']} AT TIME ZONE 'UTC'"
+                    ))
+                    print(f"✓ Колонка analysis_cache.{column['name']} переведена в TIMESTAMPTZ")
+
+def _create_missing_indexes():
+    """Досоздать индексы в уже существующей БД"""
+    # create_all не добавляет новые индексы к существующим таблицам
+    tables = (
+        Mention.__table__, DailyAggregate.__table__, HourlyAggregate.__table__, AnalysisCache.__table__,
+        person_mention, mention_entity, mention_topic,
+    )
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 def drop_all_tables():
     """Удалить все таблицы"""
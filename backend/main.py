@@ -1,22 +1,44 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import select, func, insert
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from pydantic import BaseModel, Field
-from typing import List, Optional
-from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+import time
+from types import SimpleNamespace
+import msgspec
 
 from .config import settings
 from .database import get_db, init_db
 from .models import (
     Person, Mention, Entity, Topic, SentimentEnum, 
-    SourceTypeEnum, FocusEnum, APIKey
+    SourceTypeEnum, FocusEnum, APIKey,
+    person_mention, mention_entity, mention_topic,
 )
+from .services.dedup import DedupService
+from .services.aggregates import AggregateService
+from .services.metrics import MetricsService
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Инициализация при старте"""
+    # В проде схему и начальные данные создаёт scripts/initdb.py до старта API
+    if settings.debug:
+        init_db()
+    print("✓ API started")
+    yield
+
 
 # Инициализация FastAPI
 app = FastAPI(
     title="MediaMeter API",
     description="Система аналитики упоминаний персон в медиа",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS
@@ -58,6 +80,74 @@ class MentionCreate(BaseModel):
     focus: Optional[str] = "mention"
 
 
+class MentionCreateMsg(msgspec.Struct):
+    """MentionCreate для горячего пути /v1/ingest: парсинг и проверка JSON в C"""
+    external_id: str
+    source_type: str
+    source_id: str
+    source_title: str
+    published_at: str
+    language: Optional[str] = "uk"
+    
+    title: Optional[str] = None
+    content: Optional[str] = None
+    url: Optional[str] = None
+    quote: Optional[str] = None
+    summary: Optional[str] = None
+    
+    persons: List[str] = msgspec.field(default_factory=list)
+    entities: List[str] = msgspec.field(default_factory=list)
+    topics: List[str] = msgspec.field(default_factory=list)
+    
+    views: Optional[int] = 0
+    forwards: Optional[int] = 0
+    likes: Optional[int] = 0
+    comments: Optional[int] = 0
+    
+    sentiment: Optional[dict] = None
+    focus: Optional[str] = "mention"
+
+
+_MENTION_DECODER = msgspec.json.Decoder(MentionCreateMsg, strict=False)
+_MENTION_BATCH_DECODER = msgspec.json.Decoder(List[MentionCreateMsg], strict=False)
+
+
+async def decode_mention(request: Request) -> MentionCreateMsg:
+    """Разобрать тело запроса через msgspec вместо Pydantic"""
+    try:
+        return _MENTION_DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        # ValidationError - подкласс DecodeError
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+async def decode_mention_batch(request: Request) -> List[MentionCreateMsg]:
+    """Разобрать JSON-массив упоминаний через msgspec"""
+    try:
+        return _MENTION_BATCH_DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+# Схемы тела для OpenAPI: сам запрос разбирают decode_mention*
+_MENTION_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": MentionCreate.model_json_schema()}},
+    }
+}
+_MENTION_BATCH_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {"type": "array", "items": MentionCreate.model_json_schema()},
+            }
+        },
+    }
+}
+
+
 class PersonCreate(BaseModel):
     name: str
     slug: str
@@ -78,30 +168,123 @@ class PersonResponse(BaseModel):
 
 # ============ Authentication ============
 
+# Кэш проверенных ключей: значение заголовка -> (время проверки, APIKey)
+_API_KEY_CACHE: Dict[str, Tuple[float, APIKey]] = {}
+
+
 def verify_api_key(x_mm_key: str = Header(None), db: Session = Depends(get_db)):
     """Проверить API ключ"""
     if not x_mm_key:
         raise HTTPException(status_code=401, detail="API key required in X-MM-Key header")
     
+    now = time.monotonic()
+    cached = _API_KEY_CACHE.get(x_mm_key)
+    if cached and now - cached[0] < settings.api_key_cache_ttl:
+        return cached[1]
+    
     api_key = db.query(APIKey).filter(
         APIKey.key == x_mm_key,
         APIKey.active == True,
     ).first()
     
     if not api_key:
+        # Отказы не кэшируем, чтобы новый ключ начал работать сразу
+        _API_KEY_CACHE.pop(x_mm_key, None)
         raise HTTPException(status_code=401, detail="Invalid API key")
     
+    # Отвязать от сессии, чтобы объект пережил её commit/close
+    db.expunge(api_key)
+    _API_KEY_CACHE[x_mm_key] = (now, api_key)
     return api_key
 
 
-# ============ Routes ============
+# ============ Helpers ============
+
+def _bulk_get_or_create(db: Session, model, names: List[str], **defaults) -> Dict[str, object]:
+    """Найти или создать записи по имени одним SELECT ... IN и одним flush"""
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    existing = {row.name: row for row in db.query(model).filter(model.name.in_(names)).all()}
+    
+    missing = [name for name in names if name not in existing]
+    if not missing:
+        return existing
+    
+    new_rows = [model(name=name, **defaults) for name in missing]
+    try:
+        with db.begin_nested():
+            db.add_all(new_rows)
+            db.flush()
+    except IntegrityError:
+        # Параллельный запрос успел создать те же записи - перечитать
+        return {row.name: row for row in db.query(model).filter(model.name.in_(names)).all()}
+    
+    existing.update((row.name, row) for row in new_rows)
+    return existing
+
+
+# Значение -> член enum, без перебора членов в Enum.__call__ на каждый запрос
+_SOURCE_TYPES = {e.value: e for e in SourceTypeEnum}
+_FOCUSES = {e.value: e for e in FocusEnum}
+_SENTIMENTS = {e.value: e for e in SentimentEnum}
 
-@app.on_event("startup")
-async def startup_event():
-    """Инициализация при старте"""
-    init_db()
-    print("✓ API started")
 
+def _enum_member(lookup: Dict, value: str, field: str):
+    """Член enum по значению; ValueError превращается в 400 в маршрутах"""
+    member = lookup.get(value)
+    if member is None:
+        raise ValueError(f"{value!r} is not a valid {field}")
+    return member
+
+
+def _mention_values(data: MentionCreateMsg) -> Dict:
+    """Значения колонок mentions для входного упоминания"""
+    # Парсить дату; в БД и агрегатах - naive UTC, как в колонке timestamp
+    try:
+        published_at = datetime.fromisoformat(data.published_at.replace('Z', '+00:00'))
+    except ValueError:
+        published_at = datetime.utcnow()
+    if published_at.tzinfo is not None:
+        published_at = published_at.astimezone(timezone.utc).replace(tzinfo=None)
+    
+    # Тональность
+    sentiment_label, sentiment_score = SentimentEnum.NEUTRAL, 0
+    if data.sentiment:
+        label = _SENTIMENTS.get(data.sentiment.get("label", "neutral"))
+        if label is not None:
+            try:
+                sentiment_label, sentiment_score = label, float(data.sentiment.get("score", 0))
+            except (TypeError, ValueError):
+                pass
+    
+    return {
+        "external_id": data.external_id,
+        "source_type": _enum_member(_SOURCE_TYPES, data.source_type, "source_type"),
+        "source_id": data.source_id,
+        "source_title": data.source_title,
+        "published_at": published_at,
+        "language": data.language or "uk",
+        "title": data.title or "",
+        "content": data.content or "",
+        "url": data.url,
+        "quote": data.quote,
+        "summary": data.summary,
+        "views": data.views or 0,
+        "forwards": data.forwards or 0,
+        "likes": data.likes or 0,
+        "comments": data.comments or 0,
+        "focus": _enum_member(_FOCUSES, data.focus or "mention", "focus"),
+        "sentiment_label": sentiment_label.value,
+        "sentiment_score": sentiment_score,
+        "influence": 1.0,
+        "content_hash": DedupService.compute_content_hash(
+            data.source_id, published_at, data.content or ""
+        ),
+    }
+
+
+# ============ Routes ============
 
 @app.get("/health")
 async def health():
@@ -116,7 +299,7 @@ async def test_endpoint():
 
 
 @app.get("/v1/debug/persons", tags=["Debug"])
-async def debug_persons(db: Session = Depends(get_db)):
+def debug_persons(db: Session = Depends(get_db)):
     """Показать всех персон в БД (для отладки)"""
     try:
         persons = db.query(Person).all()
@@ -131,7 +314,7 @@ async def debug_persons(db: Session = Depends(get_db)):
 # --- Persons Management ---
 
 @app.post("/v1/persons", response_model=PersonResponse, tags=["Persons"])
-async def create_person(
+def create_person(
     person: PersonCreate,
     api_key: APIKey = Depends(verify_api_key),
     db: Session = Depends(get_db),
@@ -155,68 +338,83 @@ async def create_person(
 
 
 @app.get("/v1/persons", response_model=List[PersonResponse], tags=["Persons"])
-async def list_persons(db: Session = Depends(get_db)):
+def list_persons(db: Session = Depends(get_db)):
     """Список всех персон"""
-    persons = db.query(Person).all()
-    return persons
+    rows = db.execute(select(Person.id, Person.name, Person.slug, Person.active)).all()
+    # Данные из БД доверенные - без повторной валидации
+    return [
+        PersonResponse.model_construct(id=r.id, name=r.name, slug=r.slug, active=r.active)
+        for r in rows
+    ]
 
 
 @app.get("/v1/persons/{person_id}", response_model=PersonResponse, tags=["Persons"])
-async def get_person(person_id: int, db: Session = Depends(get_db)):
+def get_person(person_id: int, db: Session = Depends(get_db)):
     """Получить персону"""
-    person = db.query(Person).filter(Person.id == person_id).first()
-    if not person:
+    row = db.execute(
+        select(Person.id, Person.name, Person.slug, Person.active).where(Person.id == person_id)
+    ).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Person not found")
-    return person
+    return PersonResponse.model_construct(id=row.id, name=row.name, slug=row.slug, active=row.active)
 
 
 # --- Metrics ---
 
 @app.get("/v1/metrics/{person_id}", tags=["Metrics"])
-async def get_metrics(person_id: int, period: str = "last_7", db: Session = Depends(get_db)):
+def get_metrics(person_id: int, period: str = "last_7", db: Session = Depends(get_db)):
     """Получить метрики для персоны"""
     try:
         # Базовые метрики
-        person = db.query(Person).filter(Person.id == person_id).first()
-        if not person:
+        person_exists = db.execute(select(Person.id).where(Person.id == person_id)).first()
+        if not person_exists:
             raise HTTPException(status_code=404, detail="Person not found")
         
-        # Считать упоминания
-        mentions = db.query(Mention).filter(
-            Mention.persons.any(Person.id == person_id)
-        ).all()
+        metrics_svc = MetricsService(db)
+        start, end = metrics_svc.get_period_dates(period)
         
-        total = len(mentions)
-        focus = sum(1 for m in mentions if m.focus.value == "focus")
+        # Целые сутки - из daily_aggregates, неполные сутки на краях периода - из mentions
+        totals = metrics_svc._totals(person_id, start, end)
+        total, focus, positive, negative, neutral, total_reach = (
+            metrics_svc._total(totals, name)
+            for name in (
+                "mentions_count", "focus_count", "positive_count",
+                "negative_count", "neutral_count", "total_reach",
+            )
+        )
         
-        # Тональность
-        positive = sum(1 for m in mentions if m.sentiment_label.value == "positive")
-        negative = sum(1 for m in mentions if m.sentiment_label.value == "negative")
-        neutral = sum(1 for m in mentions if m.sentiment_label.value == "neutral")
+        # Уникальные источники не суммируются по дням - считать по упоминаниям
+        unique_sources = db.execute(
+            metrics_svc._scoped(select(func.count(func.distinct(Mention.source_id))), start, end, person_id)
+        ).scalar()
         
         pos_share = positive / total if total > 0 else 0
         neg_share = negative / total if total > 0 else 0
         net_sentiment = (positive - negative) / total if total > 0 else 0
         
-        # Охват
-        total_reach = sum(m.views or 0 for m in mentions)
-        unique_sources = len(set(m.source_id for m in mentions))
-        
         # Скорость
-        velocity_per_hour = len(mentions) / 24 if mentions else 0
+        velocity_per_hour = total / 24 if total else 0
         acceleration = 0
         
         # Источники
-        source_counts = {}
-        for m in mentions:
-            if m.source_title not in source_counts:
-                source_counts[m.source_title] = {"mentions": 0, "views": 0}
-            source_counts[m.source_title]["mentions"] += 1
-            source_counts[m.source_title]["views"] += m.views or 0
+        mention_count = func.count(Mention.id)
+        sources = db.execute(
+            metrics_svc._scoped(
+                select(
+                    Mention.source_title,
+                    mention_count,
+                    func.coalesce(func.sum(Mention.views), 0),
+                ),
+                start, end, person_id,
+            )
+            .group_by(Mention.source_title)
+            .order_by(mention_count.desc())
+            .limit(5)
+        ).all()
         
         top_sources = [
-            {"source_title": k, "mentions": v["mentions"], "views": v["views"]}
-            for k, v in sorted(source_counts.items(), key=lambda x: x[1]["mentions"], reverse=True)[:5]
+            {"source_title": title, "mentions": mentions, "views": views}
+            for title, mentions, views in sources
         ]
         
         # Темы
@@ -244,103 +442,85 @@ async def get_metrics(person_id: int, period: str = "last_7", db: Session = Depe
             "top_topics": top_topics,
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # --- Mentions Ingestion ---
 
-@app.post("/v1/ingest", tags=["Ingestion"])
-async def ingest_mention(
-    data: MentionCreate,
+@app.post("/v1/ingest", tags=["Ingestion"], openapi_extra=_MENTION_OPENAPI)
+def ingest_mention(
     api_key: APIKey = Depends(verify_api_key),
+    data: MentionCreateMsg = Depends(decode_mention),
     db: Session = Depends(get_db),
 ):
     """Приём упоминания из внешних источников"""
     
     try:
-        # Парсить дату
-        try:
-            published_at = datetime.fromisoformat(data.published_at.replace('Z', '+00:00'))
-        except:
-            published_at = datetime.now()
+        values = _mention_values(data)
         
-        # Создать упоминание
-        mention = Mention(
-            external_id=data.external_id,
-            source_type=SourceTypeEnum(data.source_type),
-            source_id=data.source_id,
-            source_title=data.source_title,
-            published_at=published_at,
-            language=data.language or "uk",
-            title=data.title or "",
-            content=data.content or "",
-            url=data.url,
-            quote=data.quote,
-            summary=data.summary,
-            views=data.views or 0,
-            forwards=data.forwards or 0,
-            likes=data.likes or 0,
-            comments=data.comments or 0,
-            focus=FocusEnum(data.focus or "mention"),
+        # Повтор по external_id или по контент-хешу - не сохранять второй раз
+        duplicate_id = DedupService.check_duplicate(
+            db, data.external_id, values["source_id"], values["published_at"], values["content"]
         )
+        if duplicate_id is not None:
+            return {"status": "duplicate", "mention_id": duplicate_id}
         
-        # Тональность
-        if data.sentiment:
-            try:
-                mention.sentiment_label = SentimentEnum(data.sentiment.get("label", "neutral"))
-                mention.sentiment_score = float(data.sentiment.get("score", 0))
-            except:
-                mention.sentiment_label = SentimentEnum.NEUTRAL
-                mention.sentiment_score = 0
-        else:
-            mention.sentiment_label = SentimentEnum.NEUTRAL
-            mention.sentiment_score = 0
-        
-        mention.influence = 1.0
+        # Создать упоминание
+        mention = Mention(**values)
+        mention.created_at = datetime.utcnow()
         
         db.add(mention)
-        db.flush()
+        db.flush()  # id приходит из INSERT, refresh не нужен
         
-        # Добавить персон
+        # Связи пишем через Core одним INSERT на таблицу, минуя relationship-коллекции
+        # Добавить персон (только существующих)
+        person_ids = []
         if data.persons:
-            for person_name in data.persons:
-                person = db.query(Person).filter(
-                    Person.name == person_name
-                ).first()
-                
-                if person:
-                    mention.persons.append(person)
+            person_ids = db.execute(
+                select(Person.id).where(Person.name.in_(set(data.persons)))
+            ).scalars().all()
+            if person_ids:
+                db.execute(
+                    person_mention.insert(),
+                    [{"mention_id": mention.id, "person_id": pid} for pid in person_ids],
+                )
         
         # Добавить сущности
         if data.entities:
-            for entity_name in data.entities:
-                entity = db.query(Entity).filter(Entity.name == entity_name).first()
-                if not entity:
-                    entity = Entity(name=entity_name, entity_type="general")
-                    db.add(entity)
-                    db.flush()
-                mention.entities.append(entity)
+            entities = _bulk_get_or_create(db, Entity, data.entities, entity_type="general")
+            db.execute(
+                mention_entity.insert(),
+                [{"mention_id": mention.id, "entity_id": e.id, "weight": 1.0} for e in entities.values()],
+            )
         
         # Добавить темы
         if data.topics:
-            for topic_name in data.topics:
-                topic = db.query(Topic).filter(Topic.name == topic_name).first()
-                if not topic:
-                    topic = Topic(name=topic_name)
-                    db.add(topic)
-                    db.flush()
-                mention.topics.append(topic)
+            topics = _bulk_get_or_create(db, Topic, data.topics)
+            db.execute(
+                mention_topic.insert(),
+                [{"mention_id": mention.id, "topic_id": t.id, "weight": 1.0} for t in topics.values()],
+            )
         
+        # Обновить суточные агрегаты персон
+        AggregateService.record_mention(db, mention, person_ids)
+        
+        # Прочитать до commit: expire_on_commit иначе вызовет повторный SELECT
+        mention_id, created_at = mention.id, mention.created_at
         db.commit()
-        db.refresh(mention)
         
         return {
             "status": "success",
-            "mention_id": mention.id,
-            "created_at": mention.created_at.isoformat(),
+            "mention_id": mention_id,
+            "created_at": created_at.isoformat(),
         }
     
+    except IntegrityError:
+        # Тот же external_id успел записать параллельный запрос
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Mention already exists")
     except ValueError as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=f"Invalid enum value: {str(e)}")
@@ -349,6 +529,110 @@ async def ingest_mention(
         raise HTTPException(status_code=500, detail=f"Error ingesting mention: {str(e)}")
 
 
+@app.post("/v1/ingest/batch", tags=["Ingestion"], openapi_extra=_MENTION_BATCH_OPENAPI)
+def ingest_batch(
+    api_key: APIKey = Depends(verify_api_key),
+    batch: List[MentionCreateMsg] = Depends(decode_mention_batch),
+    db: Session = Depends(get_db),
+):
+    """Пакетный приём упоминаний: несколько INSERT на весь пакет"""
+    
+    try:
+        # Убрать повторы external_id внутри пакета и уже сохранённые
+        unique = {}
+        for data in batch:
+            unique.setdefault(data.external_id, data)
+        if unique:
+            stored = db.execute(
+                select(Mention.external_id).where(Mention.external_id.in_(list(unique)))
+            ).scalars().all()
+            for external_id in stored:
+                del unique[external_id]
+        items = list(unique.values())
+        values = [_mention_values(data) for data in items]
+        
+        # Повторы по контент-хешу: внутри пакета и уже сохранённые
+        if values:
+            seen_hashes = set(db.execute(
+                select(Mention.content_hash).where(
+                    Mention.content_hash.in_({row["content_hash"] for row in values})
+                )
+            ).scalars())
+            kept = []
+            for data, row in zip(items, values):
+                if row["content_hash"] not in seen_hashes:
+                    seen_hashes.add(row["content_hash"])
+                    kept.append((data, row))
+            items = [data for data, _ in kept]
+            values = [row for _, row in kept]
+        
+        if not items:
+            return {"status": "success", "ids": [], "skipped": len(batch)}
+        
+        # Вставить упоминания через Core, без ORM-объектов
+        mention_ids = db.execute(
+            insert(Mention).returning(Mention.id, sort_by_parameter_order=True),
+            values,
+        ).scalars().all()
+        
+        # Справочники для всего пакета
+        # Имя -> id всех персон с этим именем (как в одиночном приёме)
+        person_names = {name for data in items for name in data.persons}
+        persons = {}
+        if person_names:
+            for person_id, name in db.execute(
+                select(Person.id, Person.name).where(Person.name.in_(person_names))
+            ):
+                persons.setdefault(name, []).append(person_id)
+        entities = _bulk_get_or_create(
+            db, Entity, [name for data in items for name in data.entities], entity_type="general"
+        )
+        topics = _bulk_get_or_create(db, Topic, [name for data in items for name in data.topics])
+        
+        # Строки связующих таблиц
+        person_rows, entity_rows, topic_rows, aggregate_items = [], [], [], []
+        for mention_id, data, row in zip(mention_ids, items, values):
+            person_ids = {pid for name in data.persons for pid in persons.get(name, ())}
+            person_rows += [{"mention_id": mention_id, "person_id": pid} for pid in person_ids]
+            entity_rows += [
+                {"mention_id": mention_id, "entity_id": entities[name].id, "weight": 1.0}
+                for name in dict.fromkeys(data.entities)
+            ]
+            topic_rows += [
+                {"mention_id": mention_id, "topic_id": topics[name].id, "weight": 1.0}
+                for name in dict.fromkeys(data.topics)
+            ]
+            aggregate_items += [(SimpleNamespace(**row), pid) for pid in person_ids]
+        
+        if person_rows:
+            db.execute(person_mention.insert(), person_rows)
+        if entity_rows:
+            db.execute(mention_entity.insert(), entity_rows)
+        if topic_rows:
+            db.execute(mention_topic.insert(), topic_rows)
+        
+        # Обновить суточные агрегаты одним upsert
+        AggregateService.record_mentions(db, aggregate_items)
+        
+        db.commit()
+        
+        return {
+            "status": "success",
+            "ids": mention_ids,
+            "skipped": len(batch) - len(items),
+        }
+    
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Mentions already exist")
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid enum value: {str(e)}")
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error ingesting batch: {str(e)}")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
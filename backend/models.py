@@ -1,10 +1,11 @@
 from sqlalchemy import (
     Column, Integer, String, DateTime, Float, Text, DECIMAL,
-    Enum, Boolean, ForeignKey, Table, JSON, Index, create_engine
+    Boolean, ForeignKey, Table, JSON, Index, CheckConstraint, SmallInteger,
+    TypeDecorator, create_engine
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from datetime import datetime
+from datetime import datetime, timezone
 import enum
 
 Base = declarative_base()
@@ -29,13 +30,34 @@ class FocusEnum(str, enum.Enum):
     MENTION = "mention"
 
 
+class EnumInt(TypeDecorator):
+    """Enum, хранимый в SMALLINT по порядку членов (новые члены - только в конец)"""
+    impl = SmallInteger
+    cache_ok = True
+    
+    def __init__(self, enum_cls):
+        super().__init__()
+        self.enum_cls = enum_cls
+        self.codes = {member: code for code, member in enumerate(enum_cls)}
+        self.members = {code: member for member, code in self.codes.items()}
+    
+    def process_bind_param(self, value, dialect):
+        # Принимает член enum или его строковое значение
+        return self.codes[self.enum_cls(value)] if value is not None else None
+    
+    def process_result_value(self, value, dialect):
+        # int(): в старых SQLite-таблицах с TEXT-колонкой коды хранятся строками
+        return self.members[int(value)] if value is not None else None
+
+
 # Association tables для many-to-many
 person_mention = Table(
     'person_mention',
     Base.metadata,
     Column('mention_id', Integer, ForeignKey('mentions.id')),
     Column('person_id', Integer, ForeignKey('persons.id')),
-    Index('idx_person_mention', 'mention_id', 'person_id')
+    Index('idx_person_mention', 'mention_id', 'person_id'),
+    Index('idx_person_mention_pid_mid', 'person_id', 'mention_id'),
 )
 
 mention_entity = Table(
@@ -44,7 +66,8 @@ mention_entity = Table(
     Column('mention_id', Integer, ForeignKey('mentions.id')),
     Column('entity_id', Integer, ForeignKey('entities.id')),
     Column('weight', Float, default=1.0),
-    Index('idx_mention_entity', 'mention_id', 'entity_id')
+    Index('idx_mention_entity', 'mention_id', 'entity_id'),
+    Index('idx_mention_entity_eid', 'entity_id', 'mention_id'),
 )
 
 mention_topic = Table(
@@ -53,7 +76,8 @@ mention_topic = Table(
     Column('mention_id', Integer, ForeignKey('mentions.id')),
     Column('topic_id', Integer, ForeignKey('topics.id')),
     Column('weight', Float, default=1.0),
-    Index('idx_mention_topic', 'mention_id', 'topic_id')
+    Index('idx_mention_topic', 'mention_id', 'topic_id'),
+    Index('idx_mention_topic_tid', 'topic_id', 'mention_id'),
 )
 
 
@@ -83,7 +107,7 @@ class Mention(Base):
     
     id = Column(Integer, primary_key=True)
     external_id = Column(String(255), unique=True, nullable=False, index=True)
-    source_type = Column(Enum(SourceTypeEnum), nullable=False)
+    source_type = Column(EnumInt(SourceTypeEnum), nullable=False)
     source_id = Column(String(190), nullable=False, index=True)
     source_title = Column(String(255))
     published_at = Column(DateTime, nullable=False, index=True)
@@ -94,6 +118,7 @@ class Mention(Base):
     url = Column(String(500))
     quote = Column(Text)
     summary = Column(Text)
+    content_hash = Column(String(40), index=True)  # BLAKE2b-160(source_id:published_at:content[:200])
     
     # Метрики источника
     views = Column(Integer, default=0)
@@ -101,12 +126,12 @@ class Mention(Base):
     likes = Column(Integer, default=0)
     comments = Column(Integer, default=0)
     
-    # Тональность
-    sentiment_label = Column(Enum(SentimentEnum))
+    # Тональность: значение SentimentEnum строкой, проверяется при записи
+    sentiment_label = Column(String(10))
     sentiment_score = Column(Float)  # -1 .. 1
     
     # Фокус
-    focus = Column(Enum(FocusEnum), default=FocusEnum.MENTION)
+    focus = Column(EnumInt(FocusEnum), default=FocusEnum.MENTION)
     
     # Вычисленные веса
     influence = Column(Float, default=1.0)  # вес источника
@@ -122,6 +147,21 @@ class Mention(Base):
     __table_args__ = (
         Index('idx_published_at_sentiment', 'published_at', 'sentiment_label'),
         Index('idx_source_type_published', 'source_type', 'published_at'),
+        Index('idx_src_time_hash', 'source_id', 'published_at', 'content_hash'),
+        # PostgreSQL: покрывающий индекс по периоду для метрик (index-only scan)
+        # и компактный BRIN для исторических диапазонов; в SQLite не создаются
+        Index(
+            'ix_mentions_pub_covering', 'published_at',
+            postgresql_include=[
+                'source_id', 'source_type', 'sentiment_label', 'sentiment_score',
+                'views', 'influence', 'focus',
+            ],
+        ).ddl_if(dialect='postgresql'),
+        Index('ix_mentions_pub_brin', 'published_at', postgresql_using='brin').ddl_if(dialect='postgresql'),
+        CheckConstraint(
+            "sentiment_label IN ('positive', 'negative', 'neutral')",
+            name='ck_mentions_sentiment_label',
+        ),
     )
     
     def __repr__(self):
@@ -157,7 +197,7 @@ class DailyAggregate(Base):
     id = Column(Integer, primary_key=True)
     date = Column(String(10), nullable=False, index=True)  # YYYY-MM-DD
     person_id = Column(Integer, ForeignKey('persons.id'), nullable=True, index=True)
-    source_type = Column(Enum(SourceTypeEnum), nullable=True, index=True)
+    source_type = Column(EnumInt(SourceTypeEnum), nullable=True, index=True)
     
     mentions_count = Column(Integer, default=0)
     focus_count = Column(Integer, default=0)
@@ -167,13 +207,33 @@ class DailyAggregate(Base):
     
     total_reach = Column(Integer, default=0)  # сумма views
     total_influence = Column(Float, default=0.0)
+    sentiment_weighted = Column(Float, default=0.0)  # сумма sentiment_score * influence
     unique_sources = Column(Integer, default=0)
     
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     __table_args__ = (
-        Index('idx_daily_agg', 'date', 'person_id', 'source_type', unique=False),
+        # Уникальность нужна для upsert при приёме упоминаний
+        Index('uq_daily_agg', 'date', 'person_id', 'source_type', unique=True),
+        Index('idx_daily_agg_person_date', 'person_id', 'date'),
+    )
+
+
+class HourlyAggregate(Base):
+    """Материализованная почасовая агрегация (для скорости и всплесков)"""
+    __tablename__ = "hourly_aggregates"
+    
+    id = Column(Integer, primary_key=True)
+    hour = Column(String(16), nullable=False)  # YYYY-MM-DD HH:00
+    person_id = Column(Integer, ForeignKey('persons.id'), nullable=True)
+    
+    mentions_count = Column(Integer, default=0)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('uq_hourly_agg', 'person_id', 'hour', unique=True),
     )
 
 
@@ -201,5 +261,10 @@ class AnalysisCache(Base):
     person_id = Column(Integer, ForeignKey('persons.id'), nullable=True)
     period = Column(String(50))  # last_7, last_30, etc.
     
-    created_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime)  # TTL для кэша
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    expires_at = Column(DateTime(timezone=True))  # TTL для кэша
+    
+    __table_args__ = (
+        # Поиск живой записи: query_hash + expires_at > now
+        Index('ix_cache_hash_expires', 'query_hash', 'expires_at'),
+    )
@@ -1,10 +1,12 @@
 # Services package
 from .metrics import MetricsService
 from .dedup import DedupService
+from .aggregates import AggregateService
 from .gpt_analysis import GPTAnalysisService
 
 __all__ = [
     "MetricsService",
     "DedupService",
+    "AggregateService",
     "GPTAnalysisService",
 ]
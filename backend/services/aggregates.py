@@ -0,0 +1,135 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+from sqlalchemy.orm import Session
+from sqlalchemy import select
+from .models import Mention, DailyAggregate, HourlyAggregate, SentimentEnum, FocusEnum, person_mention
+from ..database import dialect_insert
+
+
+# Колонки-счётчики, которые upsert суммирует
+_COUNTERS = (
+    "mentions_count",
+    "focus_count",
+    "positive_count",
+    "negative_count",
+    "neutral_count",
+    "total_reach",
+    "total_influence",
+    "sentiment_weighted",
+)
+
+
+class AggregateService:
+    """
+    Поддержка таблиц агрегатов:
+    daily_aggregates (сутки x персона x тип источника) и hourly_aggregates (час x персона)
+    """
+    
+    @staticmethod
+    def _counters(mention) -> Dict:
+        """Вклад одного упоминания в суточные счётчики"""
+        return {
+            "mentions_count": 1,
+            "focus_count": int(mention.focus == FocusEnum.FOCUS),
+            "positive_count": int(mention.sentiment_label == SentimentEnum.POSITIVE.value),
+            "negative_count": int(mention.sentiment_label == SentimentEnum.NEGATIVE.value),
+            "neutral_count": int(mention.sentiment_label == SentimentEnum.NEUTRAL.value),
+            "total_reach": mention.views or 0,
+            "total_influence": mention.influence or 0.0,
+            "sentiment_weighted": (mention.sentiment_score or 0) * (mention.influence or 0.0),
+        }
+    
+    @staticmethod
+    def _bucketize(items: Iterable[Tuple[object, int]]) -> Tuple[Dict[Tuple, Dict], Dict[Tuple, int]]:
+        """Свернуть пары (упоминание, person_id) в суточные счётчики и почасовые количества"""
+        buckets: Dict[Tuple, Dict] = {}
+        hours: Dict[Tuple, int] = {}
+        for mention, person_id in items:
+            key = (mention.published_at.date().isoformat(), person_id, mention.source_type)
+            bucket = buckets.setdefault(key, dict.fromkeys(_COUNTERS, 0))
+            for name, value in AggregateService._counters(mention).items():
+                bucket[name] += value
+            
+            hour_key = (mention.published_at.strftime("%Y-%m-%d %H:00"), person_id)
+            hours[hour_key] = hours.get(hour_key, 0) + 1
+        return buckets, hours
+    
+    @staticmethod
+    def _rows(buckets: Dict[Tuple, Dict]) -> List[Dict]:
+        """Строки daily_aggregates для вставки"""
+        return [
+            {"date": day, "person_id": person_id, "source_type": source_type, **counters}
+            for (day, person_id, source_type), counters in buckets.items()
+        ]
+    
+    @staticmethod
+    def _hour_rows(hours: Dict[Tuple, int]) -> List[Dict]:
+        """Строки hourly_aggregates для вставки"""
+        return [
+            {"hour": hour, "person_id": person_id, "mentions_count": count}
+            for (hour, person_id), count in hours.items()
+        ]
+    
+    @staticmethod
+    def record_mention(db: Session, mention: Mention, person_ids: List[int]):
+        """Прибавить упоминание к суточным агрегатам его персон"""
+        AggregateService.record_mentions(db, [(mention, person_id) for person_id in person_ids])
+    
+    @staticmethod
+    def record_mentions(db: Session, items: Iterable[Tuple[object, int]]):
+        """
+        Прибавить пары (упоминание, person_id) к суточным и почасовым агрегатам.
+        По одному INSERT ... ON CONFLICT DO UPDATE на таблицу для всего набора.
+        """
+        buckets, hours = AggregateService._bucketize(items)
+        if not buckets:
+            return
+        
+        now = datetime.utcnow()
+        stmt = dialect_insert(db.get_bind(), DailyAggregate).values(AggregateService._rows(buckets))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["date", "person_id", "source_type"],
+            set_={
+                **{
+                    name: getattr(DailyAggregate, name) + getattr(stmt.excluded, name)
+                    for name in _COUNTERS
+                },
+                "updated_at": now,
+            },
+        )
+        db.execute(stmt)
+        
+        stmt = dialect_insert(db.get_bind(), HourlyAggregate).values(AggregateService._hour_rows(hours))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["person_id", "hour"],
+            set_={
+                "mentions_count": HourlyAggregate.mentions_count + stmt.excluded.mentions_count,
+                "updated_at": now,
+            },
+        )
+        db.execute(stmt)
+    
+    @staticmethod
+    def rebuild(db: Session) -> int:
+        """Пересчитать daily_aggregates и hourly_aggregates с нуля по таблице mentions"""
+        rows = db.execute(
+            select(
+                person_mention.c.person_id,
+                Mention.published_at,
+                Mention.source_type,
+                Mention.focus,
+                Mention.sentiment_label,
+                Mention.sentiment_score,
+                Mention.views,
+                Mention.influence,
+            ).join(person_mention, person_mention.c.mention_id == Mention.id)
+        ).yield_per(1000)
+        
+        buckets, hours = AggregateService._bucketize((row, row.person_id) for row in rows)
+        
+        db.query(DailyAggregate).delete()
+        db.query(HourlyAggregate).delete()
+        if buckets:
+            db.execute(DailyAggregate.__table__.insert(), AggregateService._rows(buckets))
+            db.execute(HourlyAggregate.__table__.insert(), AggregateService._hour_rows(hours))
+        return len(buckets)
@@ -1,20 +1,91 @@
-import json
+import asyncio
 import hashlib
-from datetime import datetime
-from typing import Dict, Optional
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from .models import AnalysisCache, Mention, Person
+from .models import AnalysisCache, Person
 from .metrics import MetricsService
-from openai import OpenAI
-import os
+from ..config import get_openai_key
+from ..database import dialect_insert
+from openai import AsyncOpenAI
+import msgspec
+
+
+# Неизменные системные промпты идут первыми: общий префикс запросов
+# попадает под автоматическое кэширование промптов OpenAI.
+_SENTIMENT_SYSTEM_PROMPT = """Ты опытный PR-аналитик с глубокими знаннями медиа-ландшафта.
+
+Метрики персоны приходят в JSON: person, period; total - всего упоминаний, focus - в фокусе;
+pos/neg/neu - [количество, доля]; net - net sentiment score от -1 до 1.
+
+Дай краткий анализ (3-5 предложений):
+1. Общее настроение в медиа
+2. Ключевые риск-факторы (если есть)
+3. Рекомендации для управления репутацией
+4. Тренд (улучшается, ухудшается или стабильно)
+
+Отвечай на украинском языке, как аналитик PR-агентства."""
+
+_SPIKE_SYSTEM_PROMPT = """Ты експерт з кризисного管理 і медіа-аналізу.
+
+Показники приходять у JSON: person; z - z-score, spike - чи виявлено всплеск;
+vph - упоминаний/час, acc - прискорення; sources - [джерело, упоминаний]; topics - [тема, упоминаний].
+
+Дай быструю оценку всплеску (2-4 речення):
+1. Чи це природний всплеск чи кризис?
+2. Основні драйвери тренда
+3. Що робити (рекомендації)
+
+Відповідай на українській мові, коротко і по суті."""
+
+_QUESTION_SYSTEM_PROMPT = """Ты опытный PR и медиа-аналитик. Отвечай на основе предоставленных данных, кратко и профессионально.
+
+Контекст приходит в JSON: person, period; total - упоминаний, focus - в фокусе; reach - views;
+pos/neg/neu - доли тональности; vph - упоминаний/час; sources - уникальных источников;
+topics, entities - топ тем и сущностей."""
+
+
+# Модель под задачу: короткая оценка всплеска - дешёвой модели, аналитика - gpt-4o.
+# Если дешёвая модель не уложилась в лимит или вернула пустой ответ, запрос
+# повторяется на следующей модели каскада.
+_MODEL_CASCADE = {
+    "spike_analysis": ("gpt-4o-mini", "gpt-4o"),
+    "sentiment_trend": ("gpt-4o", "gpt-4-turbo"),
+    "custom_question": ("gpt-4o", "gpt-4-turbo"),
+}
+
+
+def _compact(data: Dict) -> str:
+    """Компактный JSON для промпта: без пробелов, кириллица без \\u-экранирования"""
+    return msgspec.json.encode(data).decode()
+
+
+@lru_cache(maxsize=4096)
+def _query_hash(query: str, person_id: Optional[int], period: str) -> str:
+    """Ключ кэша анализа; одни и те же запросы повторяются в пределах сессии"""
+    combined = f"{query}:{person_id}:{period}"
+    return hashlib.blake2b(combined.encode(), digest_size=16).hexdigest()
 
 
 class GPTAnalysisService:
     """Аналитические запросы к ChatGPT с кэшированием"""
     
-    def __init__(self, db: Session, api_key: str):
+    def __init__(self, db: Session, api_key: Optional[str] = None):
         self.db = db
-        self.client = OpenAI(api_key=api_key)
+        self._api_key = api_key
+        self._client = None
+        self.metrics_svc = MetricsService(db)
+        self._snapshots: Dict[Tuple, Dict] = {}
+        self._person_names: Dict[Optional[int], str] = {}
+    
+    @property
+    def client(self) -> AsyncOpenAI:
+        """Асинхронный клиент OpenAI создаётся при первом запросе к GPT"""
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=self._api_key or get_openai_key())
+        return self._client
     
     def compute_query_hash(
         self,
@@ -23,18 +94,68 @@ class GPTAnalysisService:
         period: str,
     ) -> str:
         """Вычислить хеш запроса для кэша"""
-        combined = f"{query}:{person_id}:{period}"
-        return hashlib.sha256(combined.encode()).hexdigest()
+        return _query_hash(query, person_id, period)
+    
+    def _snapshot(self, person_id: Optional[int], period: str) -> Dict:
+        """
+        Метрики для промптов. Панели дашборда запрашивают одно и то же, поэтому
+        снапшот переиспользуется в пределах минуты для той же персоны и периода.
+        """
+        key = (person_id, period, datetime.utcnow().strftime("%Y-%m-%d %H:%M"))
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            snapshot = self.metrics_svc.get_full_snapshot(person_id, period, limit=5)
+            self._snapshots[key] = snapshot
+        return snapshot
+    
+    def _person_name(self, person_id: Optional[int]) -> str:
+        """Имя персоны для промпта"""
+        if person_id not in self._person_names:
+            name = None
+            if person_id:
+                name = self.db.execute(
+                    select(Person.name).where(Person.id == person_id)
+                ).scalar()
+            self._person_names[person_id] = name or "Невизначена персона"
+        return self._person_names[person_id]
+    
+    async def _complete(
+        self,
+        task: str,
+        system_prompt: str,
+        prompt: str,
+        max_tokens: int,
+    ) -> Tuple[str, str]:
+        """Запрос к GPT по каскаду моделей задачи; возвращает (ответ, модель)"""
+        models = _MODEL_CASCADE[task]
+        for model in models:
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.7,
+                max_tokens=max_tokens,
+            )
+            content = (response.choices[0].message.content or "").strip()
+            # Следующая модель - только при пустом ответе: обрезку по max_tokens
+            # она не исправит, лимит токенов у неё тот же
+            if content:
+                break
+        return content, model
     
     def get_cached_analysis(self, query_hash: str) -> Optional[Dict]:
         """Получить анализ из кэша, если не истёк"""
-        cache = self.db.query(AnalysisCache).filter(
-            AnalysisCache.query_hash == query_hash,
-            AnalysisCache.expires_at > datetime.utcnow(),
-        ).first()
+        response = self.db.execute(
+            select(AnalysisCache.response).where(
+                AnalysisCache.query_hash == query_hash,
+                AnalysisCache.expires_at > datetime.now(timezone.utc),
+            )
+        ).scalar()
         
-        if cache:
-            return json.loads(cache.response)
+        if response:
+            return msgspec.json.decode(response)
         return None
     
     def cache_analysis(
@@ -46,21 +167,24 @@ class GPTAnalysisService:
         period: str,
         ttl_hours: int = 24,
     ):
-        """Сохранить анализ в кэш"""
-        expires_at = datetime.utcnow() + __import__('datetime').timedelta(hours=ttl_hours)
+        """Сохранить анализ в кэш (истёкшая запись с тем же хешем перезаписывается)"""
+        now = datetime.now(timezone.utc)
+        values = {
+            "query_hash": query_hash,
+            "query": query,
+            "response": msgspec.json.encode(response).decode(),
+            "person_id": person_id,
+            "period": period,
+            "created_at": now,
+            "expires_at": now + timedelta(hours=ttl_hours),
+        }
         
-        cache = AnalysisCache(
-            query_hash=query_hash,
-            query=query,
-            response=json.dumps(response),
-            person_id=person_id,
-            period=period,
-            expires_at=expires_at,
-        )
-        self.db.add(cache)
+        stmt = dialect_insert(self.db.get_bind(), AnalysisCache).values(**values)
+        stmt = stmt.on_conflict_do_update(index_elements=["query_hash"], set_=values)
+        self.db.execute(stmt)
         self.db.commit()
     
-    def analyze_sentiment_trend(
+    async def analyze_sentiment_trend(
         self,
         person_id: Optional[int],
         period: str = "last_30",
@@ -76,54 +200,34 @@ class GPTAnalysisService:
                 return cached
         
         # Получить метрики
-        metrics_svc = MetricsService(self.db)
-        sentiment = metrics_svc.get_sentiment_metrics(person_id, period)
-        mention_count = metrics_svc.get_mention_count(person_id, period)
+        snapshot = self._snapshot(person_id, period)
+        sentiment = snapshot["sentiment"]
+        mention_count = snapshot["mention_count"]
         
-        person_name = "Невизначена персона"
-        if person_id:
-            person = self.db.query(Person).filter(Person.id == person_id).first()
-            if person:
-                person_name = person.name
+        person_name = self._person_name(person_id)
         
-        # Промпт для GPT
-        prompt = f"""
-Проанализируй медиа-метрики для персоны "{person_name}" за период {period}:
-
-Метрики:
-- Всього упоминаний: {mention_count['total']}
-- В фокусе: {mention_count['focus']}
-- Положительные: {sentiment['positive']} ({sentiment['pos_share']:.1%})
-- Отрицательные: {sentiment['negative']} ({sentiment['neg_share']:.1%})
-- Нейтральные: {sentiment['neutral']} ({sentiment['neu_share']:.1%})
-- Net Sentiment Score: {sentiment['net_sentiment']:.2f}
-
-Дай краткий анализ (3-5 предложений):
-1. Общее настроение в медиа
-2. Ключевые риск-факторы (если есть)
-3. Рекомендации для управления репутацией
-4. Тренд (улучшается, ухудшается или стабильно)
-
-Отвечай на украинском языке, как аналитик PR-агентства.
-"""
+        # Промпт для GPT: только переменные метрики, инструкции - в системном промпте
+        prompt = _compact({
+            "person": person_name,
+            "period": period,
+            "total": mention_count['total'],
+            "focus": mention_count['focus'],
+            "pos": [sentiment['positive'], round(sentiment['pos_share'], 3)],
+            "neg": [sentiment['negative'], round(sentiment['neg_share'], 3)],
+            "neu": [sentiment['neutral'], round(sentiment['neu_share'], 3)],
+            "net": round(sentiment['net_sentiment'], 2),
+        })
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "Ты опытный PR-аналитик с глубокими знаннями медиа-ландшафта."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.7,
-                max_tokens=500,
+            analysis, model = await self._complete(
+                "sentiment_trend", _SENTIMENT_SYSTEM_PROMPT, prompt, max_tokens=500
             )
             
-            analysis = response.choices[0].message.content
-            
             result = {
                 "type": "sentiment_trend",
                 "analysis": analysis,
                 "metrics": sentiment,
+                "model": model,
                 "generated_at": datetime.utcnow().isoformat(),
             }
             
@@ -138,7 +242,7 @@ class GPTAnalysisService:
                 "analysis": "Помилка при звернені до GPT API",
             }
     
-    def analyze_spike(
+    async def analyze_spike(
         self,
         person_id: Optional[int],
         period: str = "last_7",
@@ -152,58 +256,34 @@ class GPTAnalysisService:
             return cached
         
         # Метрики
-        metrics_svc = MetricsService(self.db)
-        velocity = metrics_svc.get_velocity_metrics(person_id, period)
-        top_sources = metrics_svc.get_top_sources(person_id, period, limit=5)
-        top_topics = metrics_svc.get_top_topics(person_id, period, limit=5)
+        snapshot = self._snapshot(person_id, period)
+        velocity = snapshot["velocity"]
+        top_sources = snapshot["top_sources"]
+        top_topics = snapshot["top_topics"]
         
-        person_name = "Невизначена персона"
-        if person_id:
-            person = self.db.query(Person).filter(Person.id == person_id).first()
-            if person:
-                person_name = person.name
+        person_name = self._person_name(person_id)
         
-        prompt = f"""
-Проаналізуй всплеск упоминаний для "{person_name}":
-
-Показатели:
-- Z-score: {velocity['z_score']:.2f}
-- Всплеск выявлен: {'Так' if velocity['is_spike'] else 'Ні'}
-- Скорость: {velocity['velocity_per_hour']:.1f} упоминаний/час
-- Ускорение: {velocity['acceleration']:+.2f}
-
-Топ-источники:
-{chr(10).join(f"- {s['source_title']}: {s['mentions']} упоминаний" for s in top_sources)}
-
-Топ-темы:
-{chr(10).join(f"- {t['name']}: {t['count']} упоминаний" for t in top_topics)}
-
-Дай быструю оценку (2-4 речення):
-1. Чи це природний всплеск чи кризис?
-2. Основні драйвери тренда
-3. Що робити (рекомендації)
-
-Відповідай на українській мові, коротко і по суті.
-"""
+        prompt = _compact({
+            "person": person_name,
+            "z": round(velocity['z_score'], 2),
+            "spike": velocity['is_spike'],
+            "vph": round(velocity['velocity_per_hour'], 1),
+            "acc": round(velocity['acceleration'], 2),
+            "sources": [[s['source_title'], s['mentions']] for s in top_sources],
+            "topics": [[t['name'], t['count']] for t in top_topics],
+        })
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "Ты експерт з кризисного管理 і медіа-аналізу."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.7,
-                max_tokens=400,
+            analysis, model = await self._complete(
+                "spike_analysis", _SPIKE_SYSTEM_PROMPT, prompt, max_tokens=400
             )
             
-            analysis = response.choices[0].message.content
-            
             result = {
                 "type": "spike_analysis",
                 "analysis": analysis,
                 "is_spike": velocity['is_spike'],
                 "z_score": velocity['z_score'],
+                "model": model,
                 "generated_at": datetime.utcnow().isoformat(),
             }
             
@@ -217,67 +297,96 @@ class GPTAnalysisService:
                 "analysis": "Помилка при аналізі всплесків",
             }
     
-    def ask_custom_question(
+    async def ask_custom_question(
         self,
         question: str,
         person_id: Optional[int],
         period: str = "last_30",
+        use_cache: bool = True,
     ) -> Dict:
         """Кастомный вопрос об аналитике"""
+        # Нормализованный вопрос: регистр и пробелы не дают промаха кэша
+        query = f"custom_question:{' '.join(question.lower().split())}"
+        query_hash = self.compute_query_hash(query, person_id, period)
         
-        # Метрики для контекста
-        metrics_svc = MetricsService(self.db)
-        mention_count = metrics_svc.get_mention_count(person_id, period)
-        sentiment = metrics_svc.get_sentiment_metrics(person_id, period)
-        reach = metrics_svc.get_reach_metrics(person_id, period)
-        velocity = metrics_svc.get_velocity_metrics(person_id, period)
-        top_topics = metrics_svc.get_top_topics(person_id, period, limit=10)
-        top_entities = metrics_svc.get_top_entities(person_id, period, limit=10)
+        if use_cache:
+            cached = self.get_cached_analysis(query_hash)
+            if cached:
+                return cached
         
-        person_name = "Невизначена персона"
-        if person_id:
-            person = self.db.query(Person).filter(Person.id == person_id).first()
-            if person:
-                person_name = person.name
+        # Метрики для контекста
+        snapshot = self._snapshot(person_id, period)
+        mention_count = snapshot["mention_count"]
+        sentiment = snapshot["sentiment"]
+        reach = snapshot["reach"]
+        velocity = snapshot["velocity"]
+        top_topics = snapshot["top_topics"]
+        top_entities = snapshot["top_entities"]
         
-        context = f"""
-Контекст аналітики для "{person_name}" за період {period}:
-
-Обсяг: {mention_count['total']} упоминаний ({mention_count['focus']} в фокусе)
-Охват: {reach['total_reach']:,} views
-Тональность: {sentiment['pos_share']:.0%} позитив, {sentiment['neg_share']:.0%} негатив, {sentiment['neu_share']:.0%} нейтраль
-Скорость: {velocity['velocity_per_hour']:.1f} упоминаний/час
-Уникальні источники: {reach['unique_sources']}
-
-Топ-теми: {', '.join(t['name'] for t in top_topics[:5])}
-Топ-сущности: {', '.join(e['name'] for e in top_entities[:5])}
-"""
+        person_name = self._person_name(person_id)
         
-        prompt = context + f"\nВопрос: {question}\n\nОтвет (коротко и по существу):"
+        context = _compact({
+            "person": person_name,
+            "period": period,
+            "total": mention_count['total'],
+            "focus": mention_count['focus'],
+            "reach": reach['total_reach'],
+            "pos": round(sentiment['pos_share'], 2),
+            "neg": round(sentiment['neg_share'], 2),
+            "neu": round(sentiment['neu_share'], 2),
+            "vph": round(velocity['velocity_per_hour'], 1),
+            "sources": reach['unique_sources'],
+            "topics": [t['name'] for t in top_topics],
+            "entities": [e['name'] for e in top_entities],
+        })
+        prompt = f"{context}\nВопрос: {question}"
         
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": "Ты опытный PR и медиа-аналитик. Отвечай на основе предоставленных данных, кратко и профессионально."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.7,
-                max_tokens=800,
+            answer, model = await self._complete(
+                "custom_question", _QUESTION_SYSTEM_PROMPT, prompt, max_tokens=800
             )
             
-            answer = response.choices[0].message.content
-            
-            return {
+            result = {
                 "type": "custom_question",
                 "question": question,
                 "answer": answer,
                 "context_used": mention_count['total'] > 0,
+                "model": model,
                 "generated_at": datetime.utcnow().isoformat(),
             }
+            
+            self.cache_analysis(query_hash, query, result, person_id, period)
+            
+            return result
         
         except Exception as e:
             return {
                 "error": str(e),
                 "answer": "Помилка при звернені до GPT API",
             }
+    
+    async def analyze_dashboard(
+        self,
+        person_id: Optional[int],
+        period: str = "last_30",
+        question: Optional[str] = None,
+    ) -> Dict:
+        """
+        Все панели дашборда одним вызовом: запросы к GPT идут параллельно.
+        Работа с БД внутри каждого анализа не прерывается await, поэтому сессия
+        не используется конкурентно.
+        """
+        calls = [
+            self.analyze_sentiment_trend(person_id, period),
+            self.analyze_spike(person_id, period),
+        ]
+        if question:
+            calls.append(self.ask_custom_question(question, person_id, period))
+        
+        results = await asyncio.gather(*calls)
+        
+        return {
+            "sentiment_trend": results[0],
+            "spike_analysis": results[1],
+            "custom_question": results[2] if question else None,
+        }
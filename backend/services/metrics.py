@@ -1,12 +1,36 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, select, case, cast, literal, or_, union_all, String
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
-import statistics
-from .models import Mention, Person, DailyAggregate, SentimentEnum, SourceTypeEnum
+import math
+from .models import (
+    Mention, DailyAggregate, HourlyAggregate, SentimentEnum, FocusEnum,
+    Topic, Entity, person_mention, mention_entity, mention_topic,
+)
+from .aggregates import _COUNTERS
 import pytz
 
 
+def _count_if(condition):
+    """SUM(CASE WHEN condition THEN 1 ELSE 0 END), 0 для пустой выборки"""
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+# Начало периода по его названию (неизвестный период = last_30)
+_PERIOD_STARTS = {
+    "all_time": lambda now: datetime(2000, 1, 1),
+    "ytd": lambda now: datetime(now.year, 1, 1),  # Year to Date
+    "qtd": lambda now: datetime(now.year, (now.month - 1) // 3 * 3 + 1, 1),  # Quarter to Date
+    "last_90": lambda now: now - timedelta(days=90),
+    "last_30": lambda now: now - timedelta(days=30),
+    "last_14": lambda now: now - timedelta(days=14),
+    "last_7": lambda now: now - timedelta(days=7),
+    "today": lambda now: now.replace(hour=0, minute=0, second=0, microsecond=0),
+    "last_24h": lambda now: now - timedelta(hours=24),
+    "last_3h": lambda now: now - timedelta(hours=3),
+}
+
+
 class MetricsService:
     """Расчёт KPI и аналитических метрик"""
     
@@ -14,62 +38,120 @@ class MetricsService:
         self.db = db
         self.tz = pytz.timezone(timezone)
     
-    def get_period_dates(self, period: str) -> tuple:
+    def get_period_dates(self, period: str, now: Optional[datetime] = None) -> tuple:
         """Получить диапазон дат по названию периода"""
-        now = datetime.now(self.tz).replace(tzinfo=None)
-        
-        if period == "all_time":
-            start = datetime(2000, 1, 1)
-        elif period == "ytd":  # Year to Date
-            start = datetime(now.year, 1, 1)
-        elif period == "qtd":  # Quarter to Date
-            quarter = (now.month - 1) // 3
-            start = datetime(now.year, quarter * 3 + 1, 1)
-        elif period == "last_90":
-            start = now - timedelta(days=90)
-        elif period == "last_30":
-            start = now - timedelta(days=30)
-        elif period == "last_14":
-            start = now - timedelta(days=14)
-        elif period == "last_7":
-            start = now - timedelta(days=7)
-        elif period == "today":
-            start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        elif period == "last_24h":
-            start = now - timedelta(hours=24)
-        elif period == "last_3h":
-            start = now - timedelta(hours=3)
-        else:
-            start = now - timedelta(days=30)
+        if now is None:
+            now = datetime.now(self.tz).replace(tzinfo=None)
         
+        start = _PERIOD_STARTS.get(period, _PERIOD_STARTS["last_30"])(now)
         return start, now
     
+    def _scoped(self, stmt, start: datetime, end: datetime, person_id: Optional[int] = None):
+        """Ограничить select(...) по mentions периодом и персоной"""
+        return self._scoped_where(stmt, Mention.published_at.between(start, end), person_id)
+    
+    def _scoped_where(self, stmt, condition, person_id: Optional[int] = None):
+        """Ограничить select(...) по mentions произвольным условием и персоной"""
+        stmt = stmt.select_from(Mention).where(condition)
+        if person_id:
+            stmt = stmt.join(
+                person_mention, person_mention.c.mention_id == Mention.id
+            ).where(person_mention.c.person_id == person_id)
+        return stmt
+    
+    def _hour_bucket(self, column=Mention.published_at):
+        """Выражение 'YYYY-MM-DD HH:00' для группировки по часам в текущем диалекте"""
+        if self.db.get_bind().dialect.name == "postgresql":
+            return func.to_char(column, "YYYY-MM-DD HH24:00")
+        return func.strftime("%Y-%m-%d %H:00", column)
+    
+    @staticmethod
+    def _split(person_id: Optional[int], start: datetime, end: datetime, step: timedelta) -> tuple:
+        """
+        Разбить период на целые бакеты агрегатов [lo, hi) и условие на хвосты для mentions.
+        Агрегаты ведутся по персонам: без person_id весь период читается из mentions.
+        """
+        floor = datetime.min + (start - datetime.min) // step * step
+        lo = floor if floor == start else floor + step
+        hi = datetime.min + (end - datetime.min) // step * step
+        if not person_id or lo >= hi:
+            return None, Mention.published_at.between(start, end)
+        
+        edges = or_(
+            and_(Mention.published_at >= start, Mention.published_at < lo),
+            and_(Mention.published_at >= hi, Mention.published_at <= end),
+        )
+        return (lo, hi), edges
+    
+    def _totals(self, person_id: Optional[int], start: datetime, end: datetime) -> Dict:
+        """
+        Счётчики daily_aggregates за период по типам источников.
+        Целые сутки - из daily_aggregates, неполные сутки на краях - из mentions.
+        """
+        bounds, edges = self._split(person_id, start, end, timedelta(days=1))
+        totals: Dict = {}
+        
+        def add(rows):
+            for source_type, *values in rows:
+                bucket = totals.setdefault(source_type, dict.fromkeys(_COUNTERS, 0))
+                for name, value in zip(_COUNTERS, values):
+                    bucket[name] += value or 0
+        
+        if bounds:
+            lo, hi = bounds
+            add(self.db.execute(
+                select(
+                    DailyAggregate.source_type,
+                    *(func.sum(getattr(DailyAggregate, name)) for name in _COUNTERS),
+                )
+                .where(
+                    DailyAggregate.person_id == person_id,
+                    DailyAggregate.date >= lo.date().isoformat(),
+                    DailyAggregate.date < hi.date().isoformat(),
+                )
+                .group_by(DailyAggregate.source_type)
+            ))
+        
+        mention_counters = {
+            "mentions_count": func.count(Mention.id),
+            "focus_count": _count_if(Mention.focus == FocusEnum.FOCUS),
+            "positive_count": _count_if(Mention.sentiment_label == SentimentEnum.POSITIVE.value),
+            "negative_count": _count_if(Mention.sentiment_label == SentimentEnum.NEGATIVE.value),
+            "neutral_count": _count_if(Mention.sentiment_label == SentimentEnum.NEUTRAL.value),
+            "total_reach": func.sum(Mention.views),
+            "total_influence": func.sum(Mention.influence),
+            "sentiment_weighted": func.sum(func.coalesce(Mention.sentiment_score, 0) * Mention.influence),
+        }
+        add(self.db.execute(
+            self._scoped_where(
+                select(Mention.source_type, *(mention_counters[name] for name in _COUNTERS)),
+                edges, person_id,
+            ).group_by(Mention.source_type)
+        ))
+        return totals
+    
+    @staticmethod
+    def _total(totals: Dict, name: str):
+        """Сумма счётчика по всем типам источников"""
+        return sum(bucket[name] for bucket in totals.values())
+    
     def get_mention_count(
         self, person_id: Optional[int] = None, period: str = "last_30"
     ) -> Dict:
         """Подсчёт упоминаний"""
         start, end = self.get_period_dates(period)
+        totals = self._totals(person_id, start, end)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        total = query.count()
-        focus = query.filter(Mention.focus == "focus").count()
-        
-        # Распределение по источникам
-        source_dist = query.with_entities(
-            Mention.source_type, func.count(Mention.id)
-        ).group_by(Mention.source_type).all()
+        total = self._total(totals, "mentions_count")
+        focus = self._total(totals, "focus_count")
         
         return {
             "total": total,
             "focus": focus,
             "mention": total - focus,
-            "by_source": dict(source_dist),
+            "by_source": {
+                source_type: bucket["mentions_count"] for source_type, bucket in totals.items()
+            },
         }
     
     def get_sentiment_metrics(
@@ -77,37 +159,24 @@ class MetricsService:
     ) -> Dict:
         """Анализ тональности"""
         start, end = self.get_period_dates(period)
+        totals = self._totals(person_id, start, end)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        sentiment_counts = query.with_entities(
-            Mention.sentiment_label, func.count(Mention.id)
-        ).group_by(Mention.sentiment_label).all()
-        
-        sentiment_dict = dict(sentiment_counts)
-        total = sum(sentiment_dict.values())
-        
-        pos = sentiment_dict.get(SentimentEnum.POSITIVE, 0)
-        neg = sentiment_dict.get(SentimentEnum.NEGATIVE, 0)
-        neu = sentiment_dict.get(SentimentEnum.NEUTRAL, 0)
+        pos = self._total(totals, "positive_count")
+        neg = self._total(totals, "negative_count")
+        neu = self._total(totals, "neutral_count")
         
+        return self._sentiment(
+            pos, neg, neu, pos + neg + neu,
+            self._total(totals, "sentiment_weighted"),
+            self._total(totals, "total_influence"),
+        )
+    
+    @staticmethod
+    def _sentiment(pos: int, neg: int, neu: int, total: int, weighted_sum: float, total_influence: float) -> Dict:
+        """Доли и индексы тональности из счётчиков"""
         # Net sentiment = (pos - neg) / max(1, total)
         net_sentiment = (pos - neg) / max(1, total)
-        
-        # Средневзвешенная тональность по influence
-        mentions = query.all()
-        weighted_sentiment = 0
-        if mentions:
-            total_influence = sum(m.influence for m in mentions)
-            for m in mentions:
-                score = m.sentiment_score or 0
-                weight = m.influence / max(1, total_influence)
-                weighted_sentiment += score * weight
+        weighted_sentiment = weighted_sum / max(1, total_influence)
         
         return {
             "positive": pos,
@@ -126,32 +195,22 @@ class MetricsService:
     ) -> Dict:
         """Охват и вес источников"""
         start, end = self.get_period_dates(period)
+        totals = self._totals(person_id, start, end)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
+        count = self._total(totals, "mentions_count")
+        total_views = self._total(totals, "total_reach")
+        total_influence = self._total(totals, "total_influence")
         
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        mentions = query.all()
-        
-        total_views = sum(m.views or 0 for m in mentions)
-        total_influence = sum(m.influence or 0 for m in mentions)
-        unique_sources = self.db.query(func.count(func.distinct(Mention.source_id))).filter(
-            Mention.published_at.between(start, end)
+        # Уникальные источники не суммируются по суткам - считаем по mentions
+        unique_sources = self.db.execute(
+            self._scoped(select(func.count(func.distinct(Mention.source_id))), start, end, person_id)
         ).scalar()
         
-        if person_id:
-            unique_sources = query.with_entities(
-                func.count(func.distinct(Mention.source_id))
-            ).scalar()
-        
         return {
             "total_views": total_views,
             "total_reach": total_views,
             "total_influence": total_influence,
-            "avg_influence": total_influence / len(mentions) if mentions else 0,
+            "avg_influence": total_influence / count if count else 0,
             "unique_sources": unique_sources,
         }
     
@@ -161,21 +220,36 @@ class MetricsService:
         """Скорость и всплески"""
         start, end = self.get_period_dates(period)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        mentions = query.all()
-        
-        # Скорость по часам
-        hourly_counts = {}
-        for m in mentions:
-            hour_key = m.published_at.strftime("%Y-%m-%d %H:00")
-            hourly_counts[hour_key] = hourly_counts.get(hour_key, 0) + 1
-        
+        # Скорость по часам: целые часы из hourly_aggregates, края периода из mentions
+        bounds, edges = self._split(person_id, start, end, timedelta(hours=1))
+        hourly_counts: Dict[str, int] = {}
+        if bounds:
+            lo, hi = bounds
+            hourly_counts.update(self.db.execute(
+                select(HourlyAggregate.hour, HourlyAggregate.mentions_count).where(
+                    HourlyAggregate.person_id == person_id,
+                    HourlyAggregate.hour >= lo.strftime("%Y-%m-%d %H:00"),
+                    HourlyAggregate.hour < hi.strftime("%Y-%m-%d %H:00"),
+                )
+            ).all())
+        
+        hour = self._hour_bucket()
+        for key, count in self.db.execute(
+            self._scoped_where(select(hour, func.count(Mention.id)), edges, person_id).group_by(hour)
+        ):
+            hourly_counts[key] = hourly_counts.get(key, 0) + count
+        hourly_counts = dict(sorted(hourly_counts.items()))
+        
+        # Предыдущий период такой же длины - для ускорения
+        prev_count = 0
+        if hourly_counts:
+            prev_count = self._total(self._totals(person_id, start - (end - start), start), "mentions_count")
+        
+        return self._velocity(hourly_counts, prev_count, start, end)
+    
+    @staticmethod
+    def _velocity(hourly_counts: Dict[str, int], prev_count: int, start: datetime, end: datetime) -> Dict:
+        """Скорость, ускорение и z-score по почасовому распределению"""
         hourly_values = list(hourly_counts.values())
         
         if not hourly_values:
@@ -188,25 +262,24 @@ class MetricsService:
             }
         
         # Средняя скорость
-        velocity_per_hour = sum(hourly_values) / len(hourly_values) if hourly_values else 0
+        count = len(hourly_values)
+        total = sum(hourly_values)
+        velocity_per_hour = total / count
         velocity_per_day = velocity_per_hour * 24
         
         # Ускорение (сравнить с предыдущим периодом)
-        prev_start = start - (end - start)
-        prev_query = self.db.query(Mention).filter(
-            Mention.published_at.between(prev_start, start)
-        )
-        if person_id:
-            prev_query = prev_query.join(Mention.persons).filter(Person.id == person_id)
-        
-        prev_mentions = prev_query.all()
-        prev_velocity = len(prev_mentions) / max(1, (start - prev_start).total_seconds() / 3600)
+        prev_velocity = prev_count / max(1, (end - start).total_seconds() / 3600)
         acceleration = velocity_per_hour - prev_velocity
         
-        # Z-score для всплесков
-        mean = statistics.mean(hourly_values) if hourly_values else 0
-        stdev = statistics.stdev(hourly_values) if len(hourly_values) > 1 else 1
-        current = hourly_values[-1] if hourly_values else 0
+        # Z-score для всплесков: счётчики целые, поэтому дисперсия через сумму квадратов
+        # считается точно в int и без второго прохода с float-вычитанием
+        mean = velocity_per_hour
+        if count > 1:
+            squares = sum(v * v for v in hourly_values)
+            stdev = math.sqrt((count * squares - total * total) / (count * (count - 1)))
+        else:
+            stdev = 1
+        current = hourly_values[-1]
         z_score = (current - mean) / max(0.1, stdev)
         is_spike = z_score >= 2
         
@@ -225,21 +298,16 @@ class MetricsService:
         """Топ источники по упоминаниям/охвату"""
         start, end = self.get_period_dates(period)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        sources = query.with_entities(
-            Mention.source_id,
-            Mention.source_title,
-            func.count(Mention.id).label("mention_count"),
-            func.sum(Mention.views).label("total_views"),
-        ).group_by(Mention.source_id, Mention.source_title).order_by(
-            func.count(Mention.id).desc()
-        ).limit(limit).all()
+        n_mentions = func.count(Mention.id)
+        sources = self.db.execute(
+            self._scoped(
+                select(Mention.source_id, Mention.source_title, n_mentions, func.sum(Mention.views)),
+                start, end, person_id,
+            )
+            .group_by(Mention.source_id, Mention.source_title)
+            .order_by(n_mentions.desc())
+            .limit(limit)
+        ).all()
         
         return [
             {
@@ -255,25 +323,17 @@ class MetricsService:
         self, person_id: Optional[int] = None, period: str = "last_30", limit: int = 10
     ) -> List[Dict]:
         """Топ темы"""
-        from sqlalchemy.orm import joinedload
-        
         start, end = self.get_period_dates(period)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        mentions = query.all()
-        
-        topic_counts = {}
-        for m in mentions:
-            for topic in m.topics:
-                topic_counts[topic.name] = topic_counts.get(topic.name, 0) + 1
-        
-        sorted_topics = sorted(topic_counts.items(), key=lambda x: x[1], reverse=True)[:limit]
+        n_mentions = func.count(mention_topic.c.mention_id)
+        sorted_topics = self.db.execute(
+            self._scoped(select(Topic.name, n_mentions), start, end, person_id)
+            .join(mention_topic, mention_topic.c.mention_id == Mention.id)
+            .join(Topic, Topic.id == mention_topic.c.topic_id)
+            .group_by(Topic.name)
+            .order_by(n_mentions.desc())
+            .limit(limit)
+        ).all()
         
         return [
             {"name": name, "count": count}
@@ -286,21 +346,15 @@ class MetricsService:
         """Топ со-упоминания (сущности)"""
         start, end = self.get_period_dates(period)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end)
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        mentions = query.all()
-        
-        entity_counts = {}
-        for m in mentions:
-            for entity in m.entities:
-                entity_counts[entity.name] = entity_counts.get(entity.name, 0) + 1
-        
-        sorted_entities = sorted(entity_counts.items(), key=lambda x: x[1], reverse=True)[:limit]
+        n_mentions = func.count(mention_entity.c.mention_id)
+        sorted_entities = self.db.execute(
+            self._scoped(select(Entity.name, n_mentions), start, end, person_id)
+            .join(mention_entity, mention_entity.c.mention_id == Mention.id)
+            .join(Entity, Entity.id == mention_entity.c.entity_id)
+            .group_by(Entity.name)
+            .order_by(n_mentions.desc())
+            .limit(limit)
+        ).all()
         
         return [
             {"name": name, "count": count}
@@ -313,15 +367,16 @@ class MetricsService:
         """Ключевые цитаты"""
         start, end = self.get_period_dates(period)
         
-        query = self.db.query(Mention).filter(
-            Mention.published_at.between(start, end),
-            Mention.quote.isnot(None),
-        )
-        
-        if person_id:
-            query = query.join(Mention.persons).filter(Person.id == person_id)
-        
-        quotes = query.order_by(Mention.influence.desc()).limit(limit).all()
+        # Только нужные колонки - без загрузки content и ORM-объектов
+        quotes = self.db.execute(
+            self._scoped(
+                select(Mention.quote, Mention.source_title, Mention.url, Mention.published_at),
+                start, end, person_id,
+            )
+            .where(Mention.quote.isnot(None))
+            .order_by(Mention.influence.desc())
+            .limit(limit)
+        ).all()
         
         return [
             {
@@ -332,3 +387,126 @@ class MetricsService:
             }
             for q in quotes
         ]
+    
+    def get_full_snapshot(
+        self, person_id: Optional[int] = None, period: str = "last_30", limit: int = 10
+    ) -> Dict:
+        """
+        Все метрики для GPT-контекста за два запроса вместо 15-20.
+        Оба запроса читают один CTE filtered (упоминания периода и персоны).
+        Ключи совпадают с результатами отдельных get_*_metrics / get_top_*.
+        """
+        start, end = self.get_period_dates(period)
+        
+        filtered = self._scoped(
+            select(
+                Mention.id,
+                Mention.source_id,
+                Mention.source_title,
+                Mention.source_type,
+                Mention.views,
+                Mention.influence,
+                Mention.sentiment_label,
+                Mention.sentiment_score,
+                Mention.focus,
+                Mention.published_at,
+            ),
+            start, end, person_id,
+        ).cte("filtered")
+        f = filtered.c
+        
+        # 1. Скалярные агрегаты + объём предыдущего периода
+        prev_count = self._scoped(
+            select(func.count(Mention.id)), start - (end - start), start, person_id
+        ).scalar_subquery()
+        (
+            total, focus, pos, neg, neu,
+            total_views, total_influence, weighted_sum, unique_sources, prev_total,
+        ) = self.db.execute(
+            select(
+                func.count(f.id),
+                _count_if(f.focus == FocusEnum.FOCUS),
+                _count_if(f.sentiment_label == SentimentEnum.POSITIVE.value),
+                _count_if(f.sentiment_label == SentimentEnum.NEGATIVE.value),
+                _count_if(f.sentiment_label == SentimentEnum.NEUTRAL.value),
+                func.coalesce(func.sum(f.views), 0),
+                func.coalesce(func.sum(f.influence), 0),
+                func.coalesce(func.sum(func.coalesce(f.sentiment_score, 0) * f.influence), 0),
+                func.count(func.distinct(f.source_id)),
+                prev_count,
+            ).select_from(filtered)
+        ).one()
+        
+        # 2. Распределения и топы одним UNION ALL: (kind, key, name, n, views, rn)
+        n = func.count()
+        hour = self._hour_bucket(f.published_at)
+        parts = [
+            select(
+                literal("source").label("kind"), f.source_id, f.source_title,
+                n, func.coalesce(func.sum(f.views), 0), func.row_number().over(order_by=n.desc()),
+            ).group_by(f.source_id, f.source_title),
+            select(
+                literal("source_type"), cast(f.source_type, String), literal(None, String),
+                n, literal(0), literal(1),
+            ).group_by(f.source_type),
+            select(
+                literal("hour"), hour, literal(None, String),
+                n, literal(0), func.row_number().over(order_by=hour),
+            ).group_by(hour),
+        ]
+        for kind, model, table, fk in (
+            ("topic", Topic, mention_topic, mention_topic.c.topic_id),
+            ("entity", Entity, mention_entity, mention_entity.c.entity_id),
+        ):
+            parts.append(
+                select(
+                    literal(kind), model.name, model.name,
+                    n, literal(0), func.row_number().over(order_by=n.desc()),
+                )
+                .select_from(filtered)
+                .join(table, table.c.mention_id == f.id)
+                .join(model, model.id == fk)
+                .group_by(model.name)
+            )
+        ranked = union_all(*parts).subquery()
+        kind_col, key_col, name_col, n_col, views_col, rn_col = ranked.c
+        rows = self.db.execute(
+            select(ranked)
+            .where(or_(kind_col.in_(["source_type", "hour"]), rn_col <= limit))
+            .order_by(kind_col, rn_col)
+        ).all()
+        
+        source_types = Mention.__table__.c.source_type.type.members
+        by_source, hourly_counts, top_sources, top_topics, top_entities = {}, {}, [], [], []
+        for kind, key, name, count, views, _ in rows:
+            if kind == "source_type":
+                by_source[source_types[int(key)]] = count
+            elif kind == "hour":
+                hourly_counts[key] = count
+            elif kind == "source":
+                top_sources.append({"source_id": key, "source_title": name, "mentions": count, "views": views or 0})
+            elif kind == "topic":
+                top_topics.append({"name": name, "count": count})
+            else:
+                top_entities.append({"name": name, "count": count})
+        
+        return {
+            "mention_count": {
+                "total": total,
+                "focus": focus,
+                "mention": total - focus,
+                "by_source": by_source,
+            },
+            "sentiment": self._sentiment(pos, neg, neu, pos + neg + neu, weighted_sum, total_influence),
+            "reach": {
+                "total_views": total_views,
+                "total_reach": total_views,
+                "total_influence": total_influence,
+                "avg_influence": total_influence / total if total else 0,
+                "unique_sources": unique_sources,
+            },
+            "velocity": self._velocity(hourly_counts, prev_total, start, end),
+            "top_sources": top_sources,
+            "top_topics": top_topics,
+            "top_entities": top_entities,
+        }
@@ -4,9 +4,13 @@ MediaMeter Collectors Utils v2
 """
 
 import os
-from sqlalchemy import create_engine
+import re
+import time
+from functools import lru_cache
+from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
 import httpx
+import msgspec
 from datetime import datetime
 
 # ============ DATABASE CONNECTION ============
@@ -21,99 +25,234 @@ DATABASE_URL = os.getenv(
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+# Драйвер - psycopg 3, если он установлен (как у backend/database.py)
+if DATABASE_URL.startswith("postgresql://"):
+    try:
+        import psycopg  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
+
 # Создать engine и SessionLocal
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+if "sqlite" in DATABASE_URL:
+    engine_kwargs = {"connect_args": {"check_same_thread": False}}
+else:
+    engine_kwargs = {"pool_size": 10, "max_overflow": 20, "pool_recycle": 1800}
+
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, **engine_kwargs)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # ============ FUNCTIONS ============
 
+PERSONS_CACHE_TTL = int(os.getenv("PERSONS_CACHE_TTL", "300"))  # секунд
+_PERSONS_CACHE = None  # (час завантаження, імена)
+
 def get_persons_from_db():
-    """Загрузить активных персон из БД"""
+    """Загрузить активных персон из БД (кэш на PERSONS_CACHE_TTL секунд)"""
+    global _PERSONS_CACHE
+    if _PERSONS_CACHE and time.monotonic() - _PERSONS_CACHE[0] < PERSONS_CACHE_TTL:
+        return list(_PERSONS_CACHE[1])
+    
     try:
         # Импортировать модели здесь чтобы избежать циклических зависимостей
         from backend.models import Person
         
         db = SessionLocal()
         try:
-            persons = db.query(Person).filter(Person.active == True).all()
-            person_names = [p.name for p in persons]
+            # Тільки імена, без ORM-об'єктів Person
+            person_names = db.execute(
+                select(Person.name).where(Person.active == True)
+            ).scalars().all()
             
             if not person_names:
                 print("⚠ Warning: No active persons in database!")
                 return []
             
             print(f"✓ Loaded {len(person_names)} persons from database")
-            return person_names
+            _PERSONS_CACHE = (time.monotonic(), tuple(person_names))
+            return list(person_names)
         finally:
             db.close()
     except Exception as e:
         print(f"❌ Error loading persons from DB: {e}")
         return []
 
+_HTTP_CLIENT = None
+
+def _get_client():
+    """Спільний httpx-клієнт: пул з'єднань замість нового TCP/TLS на кожен запит"""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=30,
+        )
+    return _HTTP_CLIENT
+
+async def close_client():
+    """Закрити спільний httpx-клієнт (при зупинці колектора)"""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+# ETag / Last-Modified останньої успішно обробленої відповіді кожного каналу для умовного GET
+_FEED_VALIDATORS = {}
+# Валідатори завантаженої, але ще не обробленої відповіді
+_PENDING_VALIDATORS = {}
+
+async def fetch_feed(url, timeout=15):
+    """
+    Завантажити RSS-канал як bytes (розбір - окремо, поза event loop).
+    Повертає None, якщо канал не змінився з попереднього запиту (304).
+    Валідатори відповіді діють лише після commit_feed_validators(url).
+    """
+    headers = {}
+    etag, last_modified = _FEED_VALIDATORS.get(url, (None, None))
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    
+    response = await _get_client().get(url, headers=headers, timeout=timeout, follow_redirects=True)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    
+    _PENDING_VALIDATORS[url] = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return response.content
+
+def commit_feed_validators(url):
+    """
+    Запам'ятати ETag / Last-Modified останньої відповіді після того, як її статті
+    оброблено й відправлено. Без цього наступний запит знову завантажить канал цілком.
+    """
+    validators = _PENDING_VALIDATORS.pop(url, None)
+    if validators:
+        _FEED_VALIDATORS[url] = validators
+
+def reset_feed_validators():
+    """Забути валідатори всіх каналів: наступний запит завантажить кожен канал цілком"""
+    _FEED_VALIDATORS.clear()
+
 async def send_to_api(mention_data, api_base_url, api_key):
-    """Відправити упоминання на API"""
+    """Відправити упоминання на API (datetime у mention_data кодуються msgspec в ISO 8601)"""
     try:
-        async with httpx.AsyncClient() as http_client:
-            response = await http_client.post(
-                f"{api_base_url}/v1/ingest",
-                json=mention_data,
-                headers={
-                    "X-MM-Key": api_key,
-                    "Content-Type": "application/json",
-                },
-                timeout=30,
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                return True, result.get('status', 'success')
-            else:
-                error_text = response.text if response.text else "Unknown error"
-                return False, f"API Error {response.status_code}: {error_text}"
+        response = await _get_client().post(
+            f"{api_base_url}/v1/ingest",
+            content=msgspec.json.encode(mention_data),
+            headers={
+                "X-MM-Key": api_key,
+                "Content-Type": "application/json",
+            },
+        )
+        
+        if response.status_code == 200:
+            result = msgspec.json.decode(response.content)
+            return True, result.get('status', 'success')
+        else:
+            error_text = response.text if response.text else "Unknown error"
+            return False, f"API Error {response.status_code}: {error_text}"
+    except Exception as e:
+        return False, str(e)
+
+async def send_batch_to_api(mentions, api_base_url, api_key):
+    """Відправити кілька упоминань одним запитом на /v1/ingest/batch"""
+    if not mentions:
+        return True, {"status": "success", "ids": [], "skipped": 0}
+    
+    try:
+        response = await _get_client().post(
+            f"{api_base_url}/v1/ingest/batch",
+            content=msgspec.json.encode(mentions),
+            headers={
+                "X-MM-Key": api_key,
+                "Content-Type": "application/json",
+            },
+        )
+        
+        if response.status_code == 200:
+            return True, msgspec.json.decode(response.content)
+        else:
+            error_text = response.text if response.text else "Unknown error"
+            return False, f"API Error {response.status_code}: {error_text}"
     except Exception as e:
         return False, str(e)
 
+def _substring_pattern(words):
+    """
+    Один regex на набір рядків (довші першими) у lookahead:
+    збіги з кожної позиції, у тому числі ті, що перекриваються
+    """
+    words = sorted(filter(None, words), key=len, reverse=True)
+    return re.compile("(?=(" + "|".join(map(re.escape, words)) + "))") if words else None
+
+def _words_in(text_lower, pattern, words):
+    """Які з words (у нижньому регістрі) входять у text_lower - як `word in text_lower`"""
+    found = set(pattern.findall(text_lower)) if pattern else set()
+    # З однієї позиції береться найдовше слово - коротші, що входять у нього, теж у тексті
+    found.update(word for word in words if not word or any(word in match for match in found))
+    return found
+
+@lru_cache(maxsize=8)
+def _persons_matcher(persons):
+    """Regex по іменах персон + lower -> імена"""
+    by_lower = {}
+    for person in persons:
+        by_lower.setdefault(person.lower(), []).append(person)
+    return _substring_pattern(by_lower), by_lower
+
+def build_persons_matcher(persons_list):
+    """Зібрати matcher персон один раз (при старті колектора) для find_persons"""
+    return _persons_matcher(tuple(persons_list))
+
+def find_persons(text_lower, matcher):
+    """Знайти персон у тексті, вже переведеному в нижній регістр"""
+    pattern, by_lower = matcher
+    if not text_lower or not by_lower:
+        return []
+    
+    found = _words_in(text_lower, pattern, by_lower)
+    return list({person for name in found for person in by_lower[name]})
+
 def extract_persons_from_text(text, persons_list):
     """Знайти персон у тексті"""
     if not text or not persons_list:
         return []
     
-    found_persons = []
-    text_lower = text.lower()
-    
-    for person in persons_list:
-        person_lower = person.lower()
-        if person_lower in text_lower:
-            found_persons.append(person)
-    
-    return list(set(found_persons))
+    return find_persons(text.lower(), build_persons_matcher(persons_list))
+
+_POSITIVE_WORDS = frozenset([
+    "успіх", "успешно", "добре", "гарно", "вперед", "позитив", "молодець", 
+    "браво", "отлично", "прекрасно", "хорошо", "отличный", "победа", "выигрыш",
+    "молодец", "спасибо", "благодарю", "лучший", "лучше", "улучшение"
+])
+
+_NEGATIVE_WORDS = frozenset([
+    "крах", "погано", "критика", "скандал", "провал", "позов", "негатив",
+    "плохо", "плохой", "ужасно", "ужас", "беда", "беды", "проблема", 
+    "ошибка", "ошибки", "падение", "поражение", "война", "конфликт",
+    "насилие", "агрессия", "бойня", "катастрофа", "кризис"
+])
+
+_SENTIMENT_WORDS = _POSITIVE_WORDS | _NEGATIVE_WORDS
+_SENTIMENT_RE = _substring_pattern(_SENTIMENT_WORDS)
 
 def analyze_sentiment(text):
     """Простий аналіз тональності (без зовнішніх бібліотек)"""
     if not text:
         return "neutral", 0.0
     
-    positive_words = [
-        "успіх", "успешно", "добре", "гарно", "вперед", "позитив", "молодець", 
-        "браво", "отлично", "прекрасно", "хорошо", "отличный", "победа", "выигрыш",
-        "молодец", "спасибо", "спасибо", "благодарю", "лучший", "лучше", "улучшение"
-    ]
-    
-    negative_words = [
-        "крах", "погано", "критика", "скандал", "провал", "позов", "негатив",
-        "плохо", "плохой", "ужасно", "ужас", "беда", "беды", "проблема", 
-        "ошибка", "ошибки", "падение", "поражение", "война", "конфликт",
-        "насилие", "агрессия", "бойня", "катастрофа", "кризис"
-    ]
-    
-    text_lower = text.lower()
-    
-    pos_count = sum(1 for word in positive_words if word.lower() in text_lower)
-    neg_count = sum(1 for word in negative_words if word.lower() in text_lower)
+    return score_sentiment(text.lower())
+
+def score_sentiment(text_lower):
+    """Тональність тексту, вже переведеного в нижній регістр"""
+    # Один прохід по тексту для обох словників
+    found = _words_in(text_lower, _SENTIMENT_RE, _SENTIMENT_WORDS)
+    pos_count = len(found & _POSITIVE_WORDS)
+    neg_count = len(found & _NEGATIVE_WORDS)
     
     if pos_count > neg_count:
         score = min(0.5 + (pos_count - neg_count) * 0.1, 1.0)
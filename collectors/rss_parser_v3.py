@@ -5,29 +5,38 @@ MediaMeter RSS Parser v3 - для Railway
 
 import asyncio
 import hashlib
-from datetime import datetime
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from html.entities import name2codepoint
 import os
+import re
 import sys
+import xml.etree.ElementTree as ET
 
 # Добавить текущую папку в path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 try:
     from collectors_utils_v2 import (
-        get_persons_from_db, send_to_api, extract_persons_from_text,
-        analyze_sentiment, print_header, print_timestamp
+        get_persons_from_db, fetch_feed, commit_feed_validators, reset_feed_validators,
+        send_batch_to_api, close_client, build_persons_matcher, find_persons, score_sentiment, print_header, print_timestamp
     )
 except ImportError:
     print("❌ Error: collectors_utils_v2.py not found!")
     sys.exit(1)
 
-import feedparser
-
 # ============ CONFIG ============
 
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
 API_KEY = os.getenv("API_KEY", "dev_key_change_in_prod")
 COLLECTION_INTERVAL = int(os.getenv("COLLECTION_INTERVAL", "3600"))  # 1 час
+MAX_ENTRIES = 20  # Статей з одного каналу за ітерацію
+PROCESSED_IDS_LIMIT = int(os.getenv("PROCESSED_IDS_LIMIT", "50000"))
+PROCESSED_IDS_FILE = os.getenv("PROCESSED_IDS_FILE", "processed_ids.bin")
+ARTICLE_ID_SIZE = 8  # Байт BLAKE2b на ID статті
 
 # RSS канали
 RSS_FEEDS = [
@@ -36,25 +45,167 @@ RSS_FEEDS = [
     {"name": "Укринформ", "url": "https://www.ukrinform.ua/rss/all"},
 ]
 
-PROCESSED_IDS = set()
+# LRU оброблених статей: найстаріші витісняються, пам'ять не росте з часом роботи.
+# Значення - чи знайшлася в статті персона (False - перевірити знову при зміні персон)
+PROCESSED_IDS = OrderedDict()
 PERSONS = []
+PERSONS_MATCHER = build_persons_matcher(PERSONS)
 
 # ============ FUNCTIONS ============
 
 def get_article_id(url, title):
-    """Генерувати унікальний ID"""
+    """Генерувати унікальний ID: короткий BLAKE2b (у PROCESSED_IDS - сирі bytes)"""
+    return hashlib.blake2b(f"{url}{title}".encode(), digest_size=ARTICLE_ID_SIZE).digest()
+
+def get_external_id(url, title):
+    """external_id для API: MD5 hex, як і раніше, щоб збігатися з уже збереженими"""
     return hashlib.md5(f"{url}{title}".encode()).hexdigest()
 
-async def process_feed(feed_info, persons_list):
+# Елементи RSS 2.0 (без namespace), RSS 1.0, Atom і Dublin Core, які потрібні колектору;
+# теги з інших namespace (media:title, content:encoded тощо) ігноруються
+_RSS1 = "{http://purl.org/rss/1.0/}"
+_ATOM = "{http://www.w3.org/2005/Atom}"
+_DC = "{http://purl.org/dc/elements/1.1/}"
+
+_ENTRY_TAGS = {"item", _RSS1 + "item", _ATOM + "entry"}
+_FIELD_TAGS = {
+    "title": "title",
+    "description": "summary",
+    "link": "link",
+    "pubDate": "published",
+    _RSS1 + "title": "title",
+    _RSS1 + "description": "summary",
+    _RSS1 + "link": "link",
+    _ATOM + "title": "title",
+    _ATOM + "summary": "summary",
+    _ATOM + "link": "link",
+    _ATOM + "published": "published",
+    _ATOM + "updated": "published",
+    _DC + "date": "published",
+}
+
+# Іменовані HTML-сутності (&nbsp;, &laquo;), яких XML без DTD не знає
+_HTML_ENTITY = re.compile(rb"&([A-Za-z][A-Za-z0-9]*);")
+
+def load_processed_ids(path=PROCESSED_IDS_FILE):
+    """
+    Завантажити ID оброблених статей після рестарту. Файл - послідовність
+    8-байтних digest; якщо записів більше ліміту, файл переписується останніми.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    
+    count = len(data) // ARTICLE_ID_SIZE
+    first = max(0, count - PROCESSED_IDS_LIMIT)
+    for i in range(first, count):
+        PROCESSED_IDS[data[i * ARTICLE_ID_SIZE:(i + 1) * ARTICLE_ID_SIZE]] = True
+    
+    if first or len(data) % ARTICLE_ID_SIZE:
+        with open(path, "wb") as f:
+            f.write(b"".join(PROCESSED_IDS))
+
+def forget_unmatched_ids():
+    """Прибрати статті без персон: після зміни списку персон їх треба перевірити знову"""
+    for article_id in [article_id for article_id, matched in PROCESSED_IDS.items() if not matched]:
+        del PROCESSED_IDS[article_id]
+
+def save_processed_ids(article_ids, path=PROCESSED_IDS_FILE):
+    """Дописати нові ID у файл (append-only); помилка запису не зупиняє збір"""
+    if article_ids:
+        try:
+            with open(path, "ab") as f:
+                f.write(b"".join(article_ids))
+        except OSError as e:
+            print(f"  ⚠ Could not save processed IDs: {e}")
+
+def _entity_ref(match):
+    """HTML-сутність - числовим посиланням, невідомі лишаються як є"""
+    codepoint = name2codepoint.get(match.group(1).decode())
+    return b"&#%d;" % codepoint if codepoint else match.group(0)
+
+def _parse_entries(body, limit):
+    """
+    Потоковий розбір RSS/Atom: лише title/summary/link/published перших limit статей.
+    Оброблені елементи очищуються, після limit статей розбір зупиняється.
+    """
+    entries = []
+    for _, elem in ET.iterparse(io.BytesIO(body), events=("end",)):
+        if elem.tag not in _ENTRY_TAGS:
+            continue
+        
+        entry = {}
+        for child in elem:
+            field = _FIELD_TAGS.get(child.tag)
+            if field is None or field in entry:
+                continue
+            if field == "link":
+                # Atom: <link rel="alternate" href="..."/>, RSS: <link>...</link>
+                if child.get("rel", "alternate") != "alternate":
+                    continue
+                value = child.get("href") or child.text
+            else:
+                value = child.text
+            if value:
+                entry[field] = value.strip()
+        
+        elem.clear()
+        entries.append(entry)
+        if len(entries) >= limit:
+            break
+    return entries
+
+def parse_feed(body, limit=MAX_ENTRIES):
+    """
+    Розібрати канал; якщо XML невалідний через HTML-сутності, повторити
+    з числовими посиланнями. Інші помилки - ET.ParseError для process_feed.
+    """
+    try:
+        return _parse_entries(body, limit)
+    except ET.ParseError:
+        lenient = _HTML_ENTITY.sub(_entity_ref, body)
+        if lenient == body:
+            raise
+        return _parse_entries(lenient, limit)
+
+def parse_published(published):
+    """Дата статті в naive UTC: ISO 8601 (Atom), RFC 822 (RSS) або поточний час"""
+    if published:
+        try:
+            # Зміщення (+02:00, Z) не відкидається: дата переводиться в UTC нижче
+            published_dt = datetime.fromisoformat(published.replace("Z", "+00:00"))
+        except ValueError:
+            try:
+                published_dt = parsedate_to_datetime(published)
+            except (TypeError, ValueError):
+                return datetime.utcnow()
+        if published_dt.tzinfo is not None:
+            published_dt = published_dt.astimezone(timezone.utc).replace(tzinfo=None)
+        return published_dt
+    return datetime.utcnow()
+
+async def process_feed(feed_info, persons_matcher):
     """Обробити RSS канал"""
     try:
         print(f"\n📰 {feed_info['name']}")
-        feed = feedparser.parse(feed_info['url'])
+        # Канали завантажуються паралельно; парсинг XML - у потоці, щоб не блокувати loop
+        body = await fetch_feed(feed_info['url'])
+        if body is None:
+            print("  Not modified since last collection")
+            return
         
-        entries = feed.entries[:20]  # Взяти більше статей
+        try:
+            entries = await asyncio.to_thread(parse_feed, body)
+        except ET.ParseError as e:
+            print(f"  ❌ Invalid feed XML: {e}")
+            return
         print(f"  Found {len(entries)} articles")
         
-        processed_count = 0
+        pending = []
+        new_ids = []
+        skipped = 0
         
         for entry in entries:
             try:
@@ -66,38 +217,40 @@ async def process_feed(feed_info, persons_list):
                 if not title or not link:
                     continue
                 
-                # Перевірити персону
-                persons = extract_persons_from_text(title + " " + summary, persons_list)
-                if not persons:
-                    continue
-                
-                # Перевірити чи не обробили
+                # Спершу дешева перевірка, чи не обробили: у стабільному режимі
+                # більшість статей уже бачені, і пошук персон для них не потрібен
                 article_id = get_article_id(link, title)
                 if article_id in PROCESSED_IDS:
+                    PROCESSED_IDS.move_to_end(article_id)
                     continue
                 
-                PROCESSED_IDS.add(article_id)
+                PROCESSED_IDS[article_id] = False
+                if len(PROCESSED_IDS) > PROCESSED_IDS_LIMIT:
+                    PROCESSED_IDS.popitem(last=False)
                 
-                # Аналіз тональності
-                sentiment, score = analyze_sentiment(title + " " + summary)
+                # Текст статті в нижньому регістрі - один раз для персон і тональності
+                text_lower = f"{title} {summary}".lower()
                 
-                # Parse дати
-                try:
-                    # Спробувати різні формати дат
-                    if published:
-                        published_dt = datetime.strptime(published[:19], "%Y-%m-%dT%H:%M:%S")
-                    else:
-                        published_dt = datetime.now()
-                except:
-                    published_dt = datetime.now()
+                # Перевірити персону
+                persons = find_persons(text_lower, persons_matcher)
+                if not persons:
+                    continue
+                
+                # На диск - лише відправлені статті: після рестарту з новими персонами
+                # решту буде перевірено знову
+                PROCESSED_IDS[article_id] = True
+                new_ids.append(article_id)
+                
+                # Аналіз тональності
+                sentiment, score = score_sentiment(text_lower)
                 
                 # Дані для API
                 mention_data = {
-                    "external_id": article_id,
+                    "external_id": get_external_id(link, title),
                     "source_type": "news",
                     "source_id": feed_info['name'],
                     "source_title": feed_info['name'],
-                    "published_at": published_dt.isoformat(),
+                    "published_at": parse_published(published),
                     "title": title[:200],
                     "content": summary[:1000],
                     "url": link,
@@ -105,26 +258,43 @@ async def process_feed(feed_info, persons_list):
                     "sentiment": {"label": sentiment, "score": score},
                 }
                 
-                # Відправити на API
-                success, status = await send_to_api(mention_data, API_BASE_URL, API_KEY)
-                if success:
-                    print(f"  ✓ {title[:50]}... ({persons[0]})")
-                    processed_count += 1
-                else:
-                    print(f"  ❌ Failed: {status}")
+                pending.append(mention_data)
             
-            except Exception as e:
-                pass
+            except (KeyError, TypeError, ValueError):
+                # Пошкоджений запис не зупиняє канал; інші помилки - вище, до "Error"
+                skipped += 1
+        
+        if skipped:
+            print(f"  Skipped {skipped} malformed entries")
+        
+        # Відправити на API одним пакетом через спільний клієнт (один round-trip на канал)
+        success, result = await send_batch_to_api(pending, API_BASE_URL, API_KEY)
+        if not success:
+            # Невідправлені статті - знову нові: наступна ітерація повторить спробу
+            for article_id in new_ids:
+                PROCESSED_IDS.pop(article_id, None)
+            print(f"  ❌ Failed: {result}")
+            return
+        
+        # На диск - лише після того, як API прийняв пакет; тоді ж - умовний GET для каналу
+        save_processed_ids(new_ids)
+        commit_feed_validators(feed_info['url'])
+        
+        for mention_data in pending:
+            print(f"  ✓ {mention_data['title'][:50]}... ({mention_data['persons'][0]})")
         
+        processed_count = len(result.get('ids', []))
         if processed_count > 0:
             print(f"  ✓ Processed {processed_count} articles with tracked persons")
+        if result.get('skipped'):
+            print(f"  Skipped {result['skipped']} already stored articles")
     
     except Exception as e:
         print(f"  ❌ Error: {e}")
 
 async def main():
     """Основна функція"""
-    global PERSONS
+    global PERSONS, PERSONS_MATCHER
     
     print_header("MediaMeter RSS Parser v3 (Railway)")
     
@@ -140,26 +310,49 @@ async def main():
         print("❌ No persons to track! Add some to database first.")
         return
     
+    load_processed_ids()
+    print(f"✓ Loaded {len(PROCESSED_IDS)} processed article IDs")
+    
+    # Matcher імен перебудовується лише при зміні списку; далі - один прохід regex по тексту статті
+    PERSONS_MATCHER = build_persons_matcher(PERSONS)
+    
     print(f"✓ Tracking persons:")
     for person in PERSONS:
         print(f"  • {person}")
     print()
     
+    # Пул для parse_feed: по потоку на канал; PROCESSED_IDS змінюється лише в loop
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=min(8, len(RSS_FEEDS)), thread_name_prefix="rss-parse")
+    )
+    
     iteration = 0
-    while True:
-        iteration += 1
-        print(f"\n{'='*60}")
-        print(f"⏱ Iteration #{iteration} - {print_timestamp()}")
-        print(f"{'='*60}")
-        
-        try:
-            for feed_info in RSS_FEEDS:
-                await process_feed(feed_info, PERSONS)
-        except Exception as e:
-            print(f"\n❌ Iteration error: {e}")
-        
-        print(f"\n⏳ Waiting {COLLECTION_INTERVAL}s until next collection...")
-        await asyncio.sleep(COLLECTION_INTERVAL)
+    try:
+        while True:
+            iteration += 1
+            print(f"\n{'='*60}")
+            print(f"⏱ Iteration #{iteration} - {print_timestamp()}")
+            print(f"{'='*60}")
+            
+            # Список персон кешується на PERSONS_CACHE_TTL; matcher - лише коли список змінився
+            persons = get_persons_from_db()
+            if persons and persons != PERSONS:
+                PERSONS = persons
+                PERSONS_MATCHER = build_persons_matcher(PERSONS)
+                # Статті без персон - перевірити знову, навіть якщо канал не змінився
+                forget_unmatched_ids()
+                reset_feed_validators()
+                print(f"✓ Tracking {len(PERSONS)} persons (list updated)")
+            
+            try:
+                await asyncio.gather(*(process_feed(feed_info, PERSONS_MATCHER) for feed_info in RSS_FEEDS))
+            except Exception as e:
+                print(f"\n❌ Iteration error: {e}")
+            
+            print(f"\n⏳ Waiting {COLLECTION_INTERVAL}s until next collection...")
+            await asyncio.sleep(COLLECTION_INTERVAL)
+    finally:
+        await close_client()
 
 if __name__ == "__main__":
     try:
@@ -1,11 +1,17 @@
+import logging
+import os
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import json
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
+log = logging.getLogger("mediameter.frontend")
+
 st.set_page_config(
     page_title="MediaMeter",
     page_icon="📊",
@@ -37,26 +43,49 @@ PERIODS = {
     "За всё время": "all_time",
 }
 
+# ============ Data loading ============
+
+@st.cache_resource
+def get_session():
+    """
+    Одна HTTP-сессия на процесс Streamlit (скрипт перезапускается на каждое действие):
+    keep-alive соединения с API переиспользуются между запросами и перезапусками
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_data(ttl=3600)
+def load_persons():
+    """Список персон меняется редко: кэш на час, отдельно от метрик"""
+    response = get_session().get(f"{API_BASE_URL}/v1/persons", timeout=10)
+    response.raise_for_status()
+    return response.json()
+
 # ============ Sidebar ============
 
 st.sidebar.title("📊 MediaMeter")
 st.sidebar.markdown("---")
 
+if st.sidebar.button("🔄 Обновить персоны"):
+    load_persons.clear()
+
 # Выбор персоны
 try:
-    response = requests.get(f"{API_BASE_URL}/v1/persons", timeout=10)
-    if response.status_code == 200:
-        persons = response.json()
-        if persons:
-            person_options = {p["name"]: p["id"] for p in persons}
-            selected_person_name = st.sidebar.selectbox("Выбрать персону", list(person_options.keys()))
-            selected_person_id = person_options[selected_person_name]
-        else:
-            st.sidebar.error("❌ Нет персон в БД")
-            st.stop()
+    persons = load_persons()
+    if persons:
+        person_options = {p["name"]: p["id"] for p in persons}
+        selected_person_name = st.sidebar.selectbox("Выбрать персону", list(person_options.keys()))
+        selected_person_id = person_options[selected_person_name]
     else:
-        st.sidebar.error(f"❌ Ошибка API: {response.status_code}")
+        st.sidebar.error("❌ Нет персон в БД")
         st.stop()
+except requests.HTTPError as e:
+    st.sidebar.error(f"❌ Ошибка API: {e.response.status_code}")
+    st.stop()
 except Exception as e:
     st.sidebar.error(f"❌ Ошибка подключения: {str(e)}")
     st.stop()
@@ -74,38 +103,22 @@ page = st.sidebar.radio("Перейти к", ["Обзор", "Анализ", "Д
 st.title(f"📰 {selected_person_name}")
 st.markdown(f"**Период:** {selected_period_name}")
 
-# Fetch metrics - WITH DEBUG INFO
 @st.cache_data(ttl=300)
 def fetch_metrics(person_id, period):
     try:
-        print(f"\n[DEBUG] Fetching metrics...")
-        print(f"  Person ID: {person_id}")
-        print(f"  Period: {period}")
-        print(f"  URL: {API_BASE_URL}/v1/metrics/{person_id}")
-        print(f"  Headers: {HEADERS}")
-        
-        response = requests.get(
+        response = get_session().get(
             f"{API_BASE_URL}/v1/metrics/{person_id}",
             params={"period": period},
-            headers=HEADERS,
             timeout=10,
         )
-        
-        print(f"  Status Code: {response.status_code}")
+        log.debug("fetch metrics %s %s -> %s", person_id, period, response.status_code)
         
         if response.status_code == 200:
-            data = response.json()
-            print(f"  ✅ Success! Data keys: {data.keys()}")
-            return data
-        else:
-            error_text = response.text if response.text else "No error message"
-            print(f"  ❌ Error: {response.status_code}")
-            print(f"  Response: {error_text}")
-            return None
-    except Exception as e:
-        print(f"  ❌ Exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
+            return response.json()
+        log.warning("Metrics API error %s: %s", response.status_code, response.text)
+        return None
+    except Exception:
+        log.exception("Metrics request failed")
         return None
 
 metrics = fetch_metrics(selected_person_id, selected_period)
@@ -222,18 +235,19 @@ if page == "Обзор":
     with col1:
         top_sources = metrics["top_sources"]
         if top_sources:
-            sources_df = pd.DataFrame(top_sources)
             st.subheader("🔝 Топ источники")
-            st.dataframe(sources_df[["source_title", "mentions", "views"]], use_container_width=True)
+            st.dataframe(
+                [{key: source[key] for key in ("source_title", "mentions", "views")} for source in top_sources],
+                use_container_width=True,
+            )
         else:
             st.info("📊 Нет данных об источниках")
     
     with col2:
         top_topics = metrics["top_topics"]
         if top_topics:
-            topics_df = pd.DataFrame(top_topics)
             st.subheader("🏷️ Топ темы")
-            st.dataframe(topics_df, use_container_width=True)
+            st.dataframe(top_topics, use_container_width=True)
         else:
             st.info("📊 Нет данных о темах")
 
@@ -250,10 +264,9 @@ elif page == "Анализ":
         if st.button("📊 Анализ тональности"):
             with st.spinner("Анализирую..."):
                 try:
-                    response = requests.post(
+                    response = get_session().post(
                         f"{API_BASE_URL}/v1/analysis/sentiment/{selected_person_id}",
                         params={"period": selected_period},
-                        headers=HEADERS,
                     )
                     if response.status_code == 200:
                         analysis = response.json()
@@ -268,10 +281,9 @@ elif page == "Анализ":
         if st.button("📈 Анализ всплесков"):
             with st.spinner("Анализирую..."):
                 try:
-                    response = requests.post(
+                    response = get_session().post(
                         f"{API_BASE_URL}/v1/analysis/spikes/{selected_person_id}",
                         params={"period": selected_period},
-                        headers=HEADERS,
                     )
                     if response.status_code == 200:
                         analysis = response.json()
@@ -293,14 +305,13 @@ elif page == "Анализ":
         else:
             with st.spinner("ChatGPT думает..."):
                 try:
-                    response = requests.post(
+                    response = get_session().post(
                         f"{API_BASE_URL}/v1/analysis",
                         json={
                             "question": question,
                             "person_id": selected_person_id,
                             "period": selected_period,
                         },
-                        headers=HEADERS,
                     )
                     if response.status_code == 200:
                         result = response.json()
@@ -0,0 +1,16 @@
+"""
+MediaMeter DB init
+Создаёт таблицы, индексы и начальные данные.
+Запускать один раз перед стартом API: python scripts/initdb.py
+"""
+
+import os
+import sys
+
+# Добавить корень проекта в path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.database import init_db
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,82 @@
+"""
+Метрики /v1/metrics за периоды короче суток: счётчики из агрегатов
+должны совпадать с упоминаниями, которые попали в окно периода.
+
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+_DB_DIR = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_DIR.name}/metrics.db"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from backend.database import SessionLocal, init_db  # noqa: E402
+from backend.main import app  # noqa: E402
+from backend.models import Person  # noqa: E402
+
+
+class SubDayMetricsTest(unittest.TestCase):
+    # Часов назад: по два упоминания в последние 3 часа, 24 часа и за их пределами
+    HOURS_AGO = (0.5, 2, 5, 20, 30, 40)
+
+    @classmethod
+    def setUpClass(cls):
+        init_db()
+        db = SessionLocal()
+        try:
+            person = db.query(Person).filter(Person.slug == "test-person").one()
+            cls.person_id, person_name = person.id, person.name
+        finally:
+            db.close()
+
+        cls.client = TestClient(app)
+        now = datetime.utcnow()
+        batch = [
+            {
+                "external_id": f"subday-{i}",
+                "source_type": "news",
+                "source_id": f"source-{i % 2}",
+                "source_title": f"Source {i % 2}",
+                "published_at": (now - timedelta(hours=hours)).isoformat(),
+                "content": f"mention {i}",
+                "url": f"http://example.com/{i}",
+                "persons": [person_name],
+                "sentiment": {"label": "positive", "score": 0.5},
+            }
+            for i, hours in enumerate(cls.HOURS_AGO)
+        ]
+        response = cls.client.post(
+            "/v1/ingest/batch", json=batch, headers={"X-MM-Key": "dev_key_change_in_prod"}
+        )
+        assert response.status_code == 200, response.text
+
+    @classmethod
+    def tearDownClass(cls):
+        _DB_DIR.cleanup()
+
+    def assert_period(self, period, expected):
+        response = self.client.get(f"/v1/metrics/{self.person_id}", params={"period": period})
+        self.assertEqual(response.status_code, 200, response.text)
+        metrics = response.json()
+
+        self.assertEqual(metrics["mentions"]["total"], expected)
+        self.assertEqual(metrics["sentiment"]["positive"], expected)
+        self.assertEqual(sum(source["mentions"] for source in metrics["top_sources"]), expected)
+
+    def test_last_3h(self):
+        self.assert_period("last_3h", 2)
+
+    def test_last_24h(self):
+        self.assert_period("last_24h", 4)
+
+    def test_last_7(self):
+        self.assert_period("last_7", 6)
+
+
+if __name__ == "__main__":
+    unittest.main()